@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Time and allocations per image of the image codec hot paths - base64_to_image, image_to_base64,
+get_resized_images and the chained resize_payload path - at SDXL sizes, with the alternatives they could
+use: JPEG quality/subsampling, JPEG draft mode, and serial vs thread pool fan-out.
+
+    python -m benchmarks.bench_image_codec --sizes 1024,2048,4096 --batch-sizes 1,4
+
+Sources are base64 images like SD WebUI responses (PNG by default, --source-format JPEG for inputs that
+draft mode applies to). Allocations are the tracemalloc peak of a batch, which covers the encoded bytes and
+base64 strings but not Pillow's pixel buffers.
+"""
+import argparse
+import base64
+import io
+import os
+import statistics
+import time
+import tracemalloc
+
+os.environ.setdefault("PLATFORM_ENV", "test")
+
+from PIL import Image
+
+import src.config as config
+from src.sd_webui_proxy.image_handle import ImageHandle
+from src.sd_webui_proxy.postprocess import materialize_images
+from src.sd_webui_proxy.sdwebui_post_callback_util import get_resized_images
+from src.sd_webui_proxy.util import base64_to_image, image_to_base64
+
+
+def make_source(size, image_format):
+    """Smooth gradients with some noise, so encoded sizes are closer to generated images than pure noise"""
+    image = Image.merge("RGB", [
+        Image.radial_gradient("L").resize((size, size)),
+        Image.linear_gradient("L").resize((size, size)),
+        Image.effect_noise((size, size), 24),
+    ])
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+def encode_jpeg(image, quality, subsampling):
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, subsampling=subsampling)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+def decode(sources, size):
+    images = [base64_to_image(source) for source in sources]
+    for image in images:
+        image.load()
+    return images
+
+
+def decode_draft(sources, size):
+    images = [base64_to_image(source) for source in sources]
+    for image in images:
+        # Only JPEG decodes at a reduced scale, other formats ignore draft
+        image.draft(image.mode, (size // 2, size // 2))
+        image.load()
+    return images
+
+
+def resize_naive(sources, size, hops=(0.5,)):
+    # Decode, resize and encode again for every hop, as before ImageHandle
+    results = list(sources)
+    for scale in hops:
+        target = (int(size * scale), int(size * scale))
+        results = [image_to_base64(base64_to_image(result).resize(target, Image.LANCZOS)) for result in results]
+    return results
+
+
+def resize_handles(sources, size, hops=(0.5,), fan_out=False):
+    images = [ImageHandle.from_base64(source) for source in sources]
+    for scale in hops:
+        images = get_resized_images(images, int(size * scale), int(size * scale))
+
+    if fan_out:
+        images = materialize_images(images)
+    else:
+        images = [image.materialize() for image in images]
+    return [image.to_base64() for image in images]
+
+
+# resize_payload to 3/4 followed by the final resize to gen_image_width/height
+CHAIN_HOPS = (0.75, 0.5)
+
+# name: (setup, run) - setup turns the sources into the run's input outside of the timing
+CASES = {
+    "decode": (None, decode),
+    "decode_draft_half": (None, decode_draft),
+    "encode_q75_default": (decode, lambda images, size: [image_to_base64(image) for image in images]),
+    "encode_q85_420": (decode, lambda images, size: [encode_jpeg(image, 85, 2) for image in images]),
+    "encode_q90_444": (decode, lambda images, size: [encode_jpeg(image, 90, 0) for image in images]),
+    "encode_png": (decode, lambda images, size: [image_to_base64(image, format="PNG") for image in images]),
+    "resize_naive": (None, resize_naive),
+    "resize_handle_serial": (None, resize_handles),
+    "resize_handle_fan_out": (None, lambda sources, size: resize_handles(sources, size, fan_out=True)),
+    "chain_naive": (None, lambda sources, size: resize_naive(sources, size, CHAIN_HOPS)),
+    "chain_handle_serial": (None, lambda sources, size: resize_handles(sources, size, CHAIN_HOPS)),
+    "chain_handle_fan_out": (None, lambda sources, size: resize_handles(sources, size, CHAIN_HOPS, fan_out=True)),
+}
+
+
+def run_case(case, sources, size, repeat):
+    setup, run = CASES[case]
+
+    timings = []
+    for _ in range(repeat):
+        inputs = setup(sources, size) if setup is not None else sources
+        started_at = time.perf_counter()
+        results = run(inputs, size)
+        timings.append(time.perf_counter() - started_at)
+
+    inputs = setup(sources, size) if setup is not None else sources
+    tracemalloc.start()
+    run(inputs, size)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    encoded = [len(result) for result in results if isinstance(result, str)]
+    return {
+        "ms_per_image": statistics.median(timings) / len(sources) * 1000,
+        "traced_peak_mb": traced_peak / 1024 / 1024,
+        # Decoded size of the base64 outputs
+        "output_kb": statistics.mean(encoded) * 3 / 4 / 1024 if encoded else None,
+    }
+
+
+def parse_ints(value):
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Image codec micro-benchmarks")
+    parser.add_argument("--sizes", type=parse_ints, default=[1024, 2048, 4096])
+    parser.add_argument("--batch-sizes", type=parse_ints, default=[1, 4])
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per case, the median is reported")
+    parser.add_argument("--source-format", default="PNG", choices=["PNG", "JPEG"])
+    parser.add_argument("--cases", default=",".join(CASES), help="Comma separated subset of the cases")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Fan out thread pool size, IMAGE_POSTPROCESS_WORKERS by default")
+    args = parser.parse_args()
+
+    if args.workers is not None:
+        # Read when the thread pool is first created
+        config.IMAGE_POSTPROCESS_WORKERS = args.workers
+
+    cases = [case for case in args.cases.split(",") if case]
+    print(f"Post-processing workers: {config.IMAGE_POSTPROCESS_WORKERS}, source format: {args.source_format}")
+    print(f"{'case':<24} {'size':>5} {'batch':>5} {'ms/image':>9} {'traced peak MB':>15} {'output KB':>10}")
+
+    for size in args.sizes:
+        source = make_source(size, args.source_format)
+        for batch_size in args.batch_sizes:
+            sources = [source] * batch_size
+            for case in cases:
+                result = run_case(case, sources, size, args.repeat)
+                output_kb = "" if result["output_kb"] is None else f"{result['output_kb']:.0f}"
+                print(f"{case:<24} {size:>5} {batch_size:>5} {result['ms_per_image']:>9.1f} "
+                      f"{result['traced_peak_mb']:>15.1f} {output_kb:>10}")
+
+
+if __name__ == "__main__":
+    main()
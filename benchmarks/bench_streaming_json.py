@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Compares peak memory and time of decoding an SD WebUI images response with response.json()
+against the streaming ImagesResponseDecoder.
+
+Each mode runs in its own process so peak RSS isn't shared between them:
+
+    python -m benchmarks.bench_streaming_json --images 4 --image-mb 8
+"""
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+
+from src.sd_webui_proxy.streaming_json import decode_images_response
+
+
+def write_response(path, images, image_mb):
+    image_bytes = int(image_mb * 1024 * 1024)
+    body = {
+        "images": [base64.b64encode(os.urandom(image_bytes)).decode('utf-8') for _ in range(images)],
+        "parameters": {"prompt": "benchmark", "batch_size": images},
+        "info": json.dumps({"all_seeds": list(range(images))}),
+    }
+    with open(path, "w") as file:
+        json.dump(body, file)
+
+
+def iter_file(path, chunk_size):
+    with open(path, "rb") as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def decode_with_json(path, chunk_size):
+    # What requests does for response.json(): join the body, decode to text, parse, then base64 decode
+    content = b"".join(iter_file(path, chunk_size))
+    response_json = json.loads(content.decode('utf-8'))
+    return [base64.b64decode(image) for image in response_json["images"]]
+
+
+def decode_streaming(path, chunk_size):
+    images, _ = decode_images_response(iter_file(path, chunk_size))
+    return images
+
+
+MODES = {
+    "json": decode_with_json,
+    "streaming": decode_streaming,
+}
+
+
+def run_mode(mode, path, chunk_size, results):
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    started_at = time.perf_counter()
+
+    images = MODES[mode](path, chunk_size)
+
+    elapsed = time.perf_counter() - started_at
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    results[mode] = {
+        "seconds": elapsed,
+        "traced_peak_mb": traced_peak / 1024 / 1024,
+        # ru_maxrss is in KB on Linux
+        "rss_growth_mb": (rss_after - rss_before) / 1024,
+        "decoded_mb": sum(len(image) for image in images) / 1024 / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming vs json images response decoding")
+    parser.add_argument("--images", type=int, default=4)
+    parser.add_argument("--image-mb", type=float, default=8.0, help="Decoded size of each image")
+    parser.add_argument("--chunk-kb", type=int, default=256)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "response.json")
+        write_response(path, args.images, args.image_mb)
+        print(f"Response body: {os.path.getsize(path) / 1024 / 1024:.1f} MB, {args.images} images")
+
+        context = multiprocessing.get_context("spawn")
+        manager = context.Manager()
+        results = manager.dict()
+        for mode in MODES:
+            process = context.Process(target=run_mode, args=(mode, path, args.chunk_kb * 1024, results))
+            process.start()
+            process.join()
+
+        print(f"{'mode':<10} {'seconds':>8} {'traced peak MB':>15} {'RSS growth MB':>14} {'decoded MB':>11}")
+        for mode in MODES:
+            result = results[mode]
+            print(f"{mode:<10} {result['seconds']:>8.3f} {result['traced_peak_mb']:>15.1f} "
+                  f"{result['rss_growth_mb']:>14.1f} {result['decoded_mb']:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
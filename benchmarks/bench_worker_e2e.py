@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+End-to-end throughput of the worker's consume path against local stand-ins, without a GPU or a broker.
+
+Messages go through QueueConsumer.on_message, worker.callback, the worker pool, message_consumer and the
+SD WebUI processor like in production. The stand-ins are:
+
+- SD WebUI: stub servers from benchmarks.stub_sd_webui, each in its own process
+- Redis: fakeredis, or a real server with --redis-url (fakeredis needs lupa for the tracking key scripts)
+- RabbitMQ: an in-memory broker playing pika's IO loop, callbacks are captured instead of published
+
+Every cell of the concurrency x image size matrix runs in a fresh process, with the worker configured
+through the environment before src is imported, and reports jobs/sec, per stage p50/p95/p99 and peak RSS:
+
+    python -m benchmarks.bench_worker_e2e --concurrency 1,4 --image-sizes 512,1024 --jobs 32
+
+Worker settings can be compared with --env, e.g. --env SD_WEBUI_STREAMING_RESPONSE=false
+"""
+import argparse
+import base64
+import io
+import json
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import resource
+import time
+from collections import defaultdict, deque
+from types import SimpleNamespace
+
+from PIL import Image
+
+from benchmarks.stub_sd_webui import add_stub_arguments, get_stub_options, start_stub_process
+
+INPUT_IMAGE_URL = "https://benchmark.s3.amazonaws.com/input.png"
+CALLBACK_ROUTING_KEY = "benchmark.callback"
+
+
+class InMemoryBroker(object):
+    """Plays RabbitMQ and pika's IO loop for a QueueConsumer.
+
+    run() delivers messages through consumer.on_message with at most prefetch_count unacknowledged, and
+    runs the callbacks dispatch and worker threads hand over with add_callback_threadsafe, all on the calling thread
+    like the SelectConnection ioloop.
+    """
+
+    def __init__(self, consumer, prefetch_count):
+        self._consumer = consumer
+        self._prefetch_count = prefetch_count
+        self._callbacks = queue.Queue()
+        self._unacked = 0
+        consumer._connection = self
+        consumer._channel = self
+
+    def add_callback_threadsafe(self, callback):
+        self._callbacks.put(callback)
+
+    def basic_ack(self, delivery_tag):
+        self._unacked -= 1
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self._unacked -= 1
+
+    def run(self, bodies, delays=None, headers=None):
+        """
+        Delivers bodies, each no earlier than its delay in seconds from the start when given, and returns once
+        all of them are acknowledged
+        """
+        pending = deque(zip(bodies, delays or [0] * len(bodies)))
+        started_at = time.monotonic()
+        delivery_tag = 0
+        while pending or self._unacked > 0:
+            timeout = None
+            if pending and self._unacked < self._prefetch_count:
+                timeout = started_at + pending[0][1] - time.monotonic()
+                if timeout <= 0:
+                    delivery_tag += 1
+                    self._unacked += 1
+                    properties = SimpleNamespace(headers=dict(headers or {}), timestamp=int(time.time()))
+                    self._consumer.on_message(self, SimpleNamespace(delivery_tag=delivery_tag), properties,
+                                              pending.popleft()[0])
+                    continue
+
+            try:
+                callback = self._callbacks.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            callback()
+
+
+def make_job(index, image_size, endpoint, batch_size, checkpoints, resize, upscale):
+    payload = {
+        "prompt": "a benchmark",
+        "negative_prompt": "",
+        "steps": 20,
+        "width": image_size,
+        "height": image_size,
+        "batch_size": batch_size,
+        "seed": index,
+    }
+    if endpoint == "img2img":
+        payload["init_images"] = [INPUT_IMAGE_URL]
+        payload["denoising_strength"] = 0.5
+
+    job = {
+        # One chain of requests, each feeding its images to the next
+        "requests": [[{"endpoint": f"sdapi/v1/{endpoint}", "payload": payload}]],
+        "sd_webui_options_payload": {"sd_model_checkpoint": f"benchmark_{index % checkpoints}.safetensors"},
+        "callback_message": {
+            "routing_key": CALLBACK_ROUTING_KEY,
+            "payload": {
+                "job_id": f"benchmark-{index}",
+                "gen_image_width": int(image_size * resize),
+                "gen_image_height": int(image_size * resize),
+            },
+        },
+    }
+    if upscale > 0:
+        job["upscale_payload"] = {"upscaling_resize": upscale, "upscaler_1": "R-ESRGAN 4x+"}
+    return job
+
+
+def percentile(samples, percent):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(percent / 100 * len(ordered)) - 1))]
+
+
+def make_input_image(image_size):
+    buffer = io.BytesIO()
+    Image.effect_noise((image_size, image_size), 64).convert("RGB").save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+def get_cell_env(args, endpoints, concurrency):
+    env = {
+        # Keeps src.common.redis from connecting, the harness swaps in its own redis below
+        "PLATFORM_ENV": "test",
+        "SD_WEBUI_API_ENDPOINT": endpoints[0],
+        "SD_WEBUI_API_ENDPOINTS": ",".join(endpoints),
+        # Result keys are plain s3 urls, nothing is uploaded
+        "R2_ENABLED": "false",
+        "SD_WEBUI_HEALTH_CHECK_INTERVAL": "0",
+        "JOB_CANCELLATION_POLL_INTERVAL": "0",
+        "WORKER_EXECUTION_MODE": "pool",
+        "WORKER_CONCURRENCY": str(concurrency),
+        "METRICS_PORT": "0",
+        "TRACING_EXPORTER": "none",
+    }
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+
+def get_redis(redis_url):
+    if redis_url:
+        import redis
+        return redis.Redis.from_url(redis_url)
+
+    import fakeredis
+    return fakeredis.FakeRedis()
+
+
+def start_worker(redis_url=None):
+    """
+    Imports the worker, configured by the environment the caller set, wires it to the stand-ins and returns
+    (broker, redis_connection, callbacks, stages) - the published callback payloads and the observed seconds
+    per stage
+    """
+    import src.config as config
+    import src.common.redis
+    import src.sd_webui_proxy.util as util
+    import worker
+    from src.common import amqp
+    from src.common.amqp import QueueConsumer
+    from src.common.metrics import stage_duration
+    from src.common.worker_pool import WorkerPool
+    from src.sd_webui_proxy.backend_pool import get_backend_pool
+    from src.sd_webui_proxy.sdwebui_post_callback import (sd_webui_post_callback_expired,
+                                                          sd_webui_post_callback_processor)
+
+    logging.disable(logging.INFO)
+
+    redis_connection = get_redis(redis_url)
+    src.common.redis.redis_connection = redis_connection
+    util.redis_connection = redis_connection
+
+    callbacks = []
+    amqp.publish = lambda exchange_name, routing_key, data, *publish_args, **publish_kwargs: callbacks.append(data)
+
+    stages = defaultdict(list)
+    observe = stage_duration.observe
+
+    def record_stage(value, **labels):
+        stages[labels["stage"]].append(value)
+        observe(value, **labels)
+
+    stage_duration.observe = record_stage
+
+    worker.worker_name = "benchmark"
+    worker.message_processor = sd_webui_post_callback_processor
+    worker.expired_message_processor = sd_webui_post_callback_expired
+    worker.worker_pool = WorkerPool(max_workers=config.WORKER_CONCURRENCY, name="benchmark")
+    worker.worker_pool.start()
+    get_backend_pool().check_readiness(init_sleep_seconds=0)
+
+    prefetch_count = max(config.WORKER_PREFETCH_COUNT, config.WORKER_CONCURRENCY)
+    consumer = QueueConsumer(config.RABBIT_URL, "benchmark", worker.callback, prefetch_count=prefetch_count)
+    return InMemoryBroker(consumer, prefetch_count), redis_connection, callbacks, stages
+
+
+def stop_worker():
+    import worker
+    worker.worker_pool.shutdown(wait=True)
+
+
+def get_stage_stats(stages):
+    return {
+        stage: {
+            "count": len(samples),
+            "p50": percentile(samples, 50),
+            "p95": percentile(samples, 95),
+            "p99": percentile(samples, 99),
+        }
+        for stage, samples in stages.items() if samples
+    }
+
+
+def run_cell(args, endpoints, concurrency, image_size, results):
+    os.environ.update(get_cell_env(args, endpoints, concurrency))
+    broker, redis_connection, callbacks, stages = start_worker(args.redis_url)
+
+    # Input of img2img jobs, stored as base64 like upstream services do
+    redis_connection.set(INPUT_IMAGE_URL, make_input_image(image_size))
+
+    def make_bodies(count, offset):
+        return [
+            json.dumps(make_job(offset + index, image_size, args.endpoint, args.batch_size, args.checkpoints,
+                                args.resize, args.upscale)).encode("utf-8")
+            for index in range(count)
+        ]
+
+    # Warm up connections, image caches and checkpoints before measuring
+    broker.run(make_bodies(args.warmup_jobs, offset=args.jobs))
+    stages.clear()
+    callbacks.clear()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    bodies = make_bodies(args.jobs, offset=0)
+    started_at = time.perf_counter()
+    broker.run(bodies)
+    elapsed = time.perf_counter() - started_at
+
+    stop_worker()
+
+    results[(concurrency, image_size)] = {
+        "jobs": len(bodies),
+        "failed": sum(1 for callback in callbacks if not callback.get("result_images")),
+        "seconds": elapsed,
+        "jobs_per_second": len(bodies) / elapsed,
+        # ru_maxrss is in KB on Linux
+        "rss_before_mb": rss_before / 1024,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": get_stage_stats(stages),
+    }
+
+
+def parse_ints(value):
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end worker throughput against local stand-ins")
+    parser.add_argument("--concurrency", type=parse_ints, default=[1, 4], help="Comma separated worker slots")
+    parser.add_argument("--image-sizes", type=parse_ints, default=[512, 1024], help="Comma separated sizes")
+    parser.add_argument("--jobs", type=int, default=32, help="Measured jobs per cell")
+    parser.add_argument("--warmup-jobs", type=int, default=4)
+    parser.add_argument("--endpoint", default="txt2img", choices=["txt2img", "img2img"])
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--checkpoints", type=int, default=1, help="Checkpoints the jobs cycle through")
+    parser.add_argument("--resize", type=float, default=0.5, help="Final size as a fraction of the image size")
+    parser.add_argument("--upscale", type=float, default=0, help="Upscale factor, 0 skips upscaling")
+    parser.add_argument("--backends", type=int, default=1, help="Stub SD WebUI servers")
+    parser.add_argument("--redis-url", default=None, help="Use this redis instead of fakeredis")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE worker setting, repeatable")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    manager = context.Manager()
+    results = manager.dict()
+
+    for image_size in args.image_sizes:
+        for concurrency in args.concurrency:
+            stubs = [start_stub_process(**get_stub_options(args)) for _ in range(args.backends)]
+            try:
+                process = context.Process(target=run_cell, args=(
+                    args, [url for _, url in stubs], concurrency, image_size, results))
+                process.start()
+                process.join()
+            finally:
+                for stub_process, _ in stubs:
+                    stub_process.terminate()
+
+            if (concurrency, image_size) not in results:
+                print(f"concurrency {concurrency}, size {image_size}: failed, exit code {process.exitcode}")
+
+    print(f"{'concurrency':>11} {'size':>5} {'jobs':>5} {'failed':>6} {'seconds':>8} {'jobs/s':>7} "
+          f"{'RSS MB':>7} {'peak RSS MB':>11}")
+    for image_size in args.image_sizes:
+        for concurrency in args.concurrency:
+            result = results.get((concurrency, image_size))
+            if result is None:
+                continue
+            print(f"{concurrency:>11} {image_size:>5} {result['jobs']:>5} {result['failed']:>6} "
+                  f"{result['seconds']:>8.2f} {result['jobs_per_second']:>7.2f} "
+                  f"{result['rss_before_mb']:>7.1f} {result['peak_rss_mb']:>11.1f}")
+
+    for image_size in args.image_sizes:
+        for concurrency in args.concurrency:
+            result = results.get((concurrency, image_size))
+            if result is None:
+                continue
+            print(f"\nconcurrency {concurrency}, size {image_size} - stage latency in ms")
+            print(f"{'stage':<20} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+            for stage, stats in sorted(result["stages"].items()):
+                print(f"{stage:<20} {stats['count']:>6} {stats['p50'] * 1000:>9.1f} "
+                      f"{stats['p95'] * 1000:>9.1f} {stats['p99'] * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Replays a corpus recorded by the worker (RECORD_CORPUS_DIR) through the consume path against stub SD WebUI
+servers, with the same stand-ins as benchmarks.bench_worker_e2e.
+
+Messages are delivered at their recorded rate, --speed times faster, or all at once with --speed 0, and
+their images are put back into redis under the recorded keys. Reports jobs/sec and the stage latencies of
+the replay next to the recorded ones:
+
+    python -m benchmarks.replay_corpus tmp/corpus --concurrency 4 --speed 2
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import time
+from collections import Counter, defaultdict
+
+from benchmarks.bench_worker_e2e import get_cell_env, get_stage_stats, start_worker, stop_worker
+from benchmarks.stub_sd_webui import add_stub_arguments, get_stub_options, start_stub_process
+
+# Replayed messages would be long past these
+DEADLINE_FIELDS = ("deadline", "created_at", "ttl_seconds")
+
+
+def get_job_kind(params):
+    """The mix a message belongs to, e.g. img2img+interrogate>txt2img+upscale"""
+    chains = []
+    for chain in params.get("requests") or []:
+        steps = []
+        for request in chain or []:
+            step = (request.get("endpoint") or "").strip("/").split("/")[-1]
+            payload = request.get("payload") or {}
+            if request.get("interrogate_model"):
+                step += "+interrogate"
+            if ((payload.get("alwayson_scripts") or {}).get("controlnet") or {}).get("args"):
+                step += "+controlnet"
+            steps.append(step)
+        chains.append(">".join(steps))
+
+    kind = ",".join(chains) or "empty"
+    if params.get("upscale_payload"):
+        kind += "+upscale"
+    return kind
+
+
+def get_recorded_stages(messages):
+    stages = defaultdict(list)
+    for message in messages:
+        for stage, _, seconds in message.get("stages") or []:
+            stages[stage].append(seconds)
+    return stages
+
+
+def run_replay(args, endpoints, results):
+    os.environ.update(get_cell_env(args, endpoints, args.concurrency))
+    broker, redis_connection, callbacks, stages = start_worker(args.redis_url)
+
+    from src.sd_webui_proxy.recorder import read_corpus, read_corpus_image
+
+    messages = read_corpus(args.corpus_dir)[:args.limit or None]
+    for message in messages:
+        for image_key, digest in (message.get("images") or {}).items():
+            redis_connection.set(image_key, read_corpus_image(args.corpus_dir, digest))
+
+        if not args.keep_deadlines:
+            callback_message = message["params"].get("callback_message") or {}
+            for field in DEADLINE_FIELDS:
+                callback_message.pop(field, None)
+
+    first_recorded_at = messages[0]["recorded_at"] if messages else 0
+    delays = [
+        (message["recorded_at"] - first_recorded_at) / args.speed if args.speed > 0 else 0
+        for message in messages
+    ]
+    bodies = [json.dumps(message["params"]).encode("utf-8") for message in messages]
+
+    started_at = time.perf_counter()
+    broker.run(bodies, delays=delays)
+    elapsed = time.perf_counter() - started_at
+
+    stop_worker()
+
+    results["replay"] = {
+        "jobs": len(bodies),
+        "failed": sum(1 for callback in callbacks if not callback.get("result_images")),
+        "seconds": elapsed,
+        "jobs_per_second": len(bodies) / elapsed if elapsed > 0 else 0,
+        "recorded_seconds": (messages[-1]["recorded_at"] - first_recorded_at) if messages else 0,
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "mix": Counter(get_job_kind(message["params"]) for message in messages),
+        "stages": get_stage_stats(stages),
+        "recorded_stages": get_stage_stats(get_recorded_stages(messages)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded message corpus against stub SD WebUI servers")
+    parser.add_argument("corpus_dir")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay rate vs recorded, 0 = all at once")
+    parser.add_argument("--limit", type=int, default=0, help="Replay only the first N messages")
+    parser.add_argument("--concurrency", type=int, default=1, help="Worker slots")
+    parser.add_argument("--keep-deadlines", action="store_true", help="Keep the recorded message deadlines")
+    parser.add_argument("--backends", type=int, default=1, help="Stub SD WebUI servers")
+    parser.add_argument("--redis-url", default=None, help="Use this redis instead of fakeredis")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE worker setting, repeatable")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    manager = context.Manager()
+    results = manager.dict()
+
+    stubs = [start_stub_process(**get_stub_options(args)) for _ in range(args.backends)]
+    try:
+        process = context.Process(target=run_replay, args=(args, [url for _, url in stubs], results))
+        process.start()
+        process.join()
+    finally:
+        for stub_process, _ in stubs:
+            stub_process.terminate()
+
+    result = results.get("replay")
+    if result is None:
+        print(f"Replay failed, exit code {process.exitcode}")
+        return
+
+    print(f"{'kind':<48} {'jobs':>5}")
+    for kind, count in result["mix"].most_common():
+        print(f"{kind:<48} {count:>5}")
+
+    print(f"\n{result['jobs']} jobs ({result['failed']} failed) in {result['seconds']:.2f}s, recorded over "
+          f"{result['recorded_seconds']:.2f}s - {result['jobs_per_second']:.2f} jobs/s, "
+          f"peak RSS {result['peak_rss_mb']:.1f} MB")
+
+    print(f"\n{'stage':<20} {'count':>6} {'recorded p50':>13} {'recorded p95':>13} {'p50':>9} {'p95':>9} {'p99':>9}"
+          f"  (ms)")
+    recorded_stages = result["recorded_stages"]
+    for stage in sorted(set(result["stages"]) | set(recorded_stages)):
+        stats = result["stages"].get(stage)
+        recorded = recorded_stages.get(stage)
+        replayed = (f"{stats['p50'] * 1000:>9.1f} {stats['p95'] * 1000:>9.1f} {stats['p99'] * 1000:>9.1f}"
+                    if stats else f"{'':>9} {'':>9} {'':>9}")
+        recorded = (f"{recorded['p50'] * 1000:>13.1f} {recorded['p95'] * 1000:>13.1f}"
+                    if recorded else f"{'':>13} {'':>13}")
+        print(f"{stage:<20} {(stats or {}).get('count', 0):>6} {recorded} {replayed}")
+
+
+if __name__ == "__main__":
+    main()
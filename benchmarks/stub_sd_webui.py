@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Stand-in for an SD WebUI server for benchmarks: answers txt2img, img2img, options, extra-batch-images,
+interrogate, progress and interrupt like the real API, without a GPU.
+
+Generation sleeps for --latency seconds plus --latency-per-megapixel for every output megapixel, with at
+most --gpu-slots generations at a time like a single GPU. Images are noise of the requested size, encoded
+once per size and reused.
+
+    python -m benchmarks.stub_sd_webui --port 7860 --latency 0.5
+"""
+import argparse
+import base64
+import io
+import json
+import multiprocessing
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+DEFAULT_OPTIONS = {
+    "sd_model_checkpoint": "stub.safetensors",
+    "sd_vae": "Automatic",
+    "CLIP_stop_at_last_layers": 1,
+}
+
+
+class StubState(object):
+    def __init__(self, latency=0.05, latency_per_megapixel=0.02, switch_latency=0.5, gpu_slots=1,
+                 image_format="PNG"):
+        self.latency = latency
+        self.latency_per_megapixel = latency_per_megapixel
+        self.switch_latency = switch_latency
+        self.image_format = image_format
+        self.options = dict(DEFAULT_OPTIONS)
+        self._gpu = threading.Semaphore(gpu_slots)
+        self._interrupted = threading.Event()
+        self._lock = threading.Lock()
+        self._images = {}
+        self._job_count = 0
+        self.requests = 0
+
+    def get_image(self, width, height):
+        """base64 image of the given size, encoded on first use"""
+        key = (width, height)
+        with self._lock:
+            image = self._images.get(key)
+        if image is None:
+            buffer = io.BytesIO()
+            Image.effect_noise((width, height), 64).convert("RGB").save(buffer, format=self.image_format)
+            image = base64.b64encode(buffer.getvalue()).decode("utf-8")
+            with self._lock:
+                self._images[key] = image
+        return image
+
+    def run_on_gpu(self, seconds):
+        """Holds a GPU slot for seconds, or until interrupted"""
+        with self._gpu:
+            with self._lock:
+                self._job_count += 1
+                self.requests += 1
+            try:
+                if self._interrupted.wait(seconds):
+                    self._interrupted.clear()
+            finally:
+                with self._lock:
+                    self._job_count -= 1
+
+    def get_generation_seconds(self, width, height, images):
+        return self.latency + self.latency_per_megapixel * width * height * images / 1e6
+
+    def interrupt(self):
+        with self._lock:
+            if self._job_count > 0:
+                self._interrupted.set()
+
+    @property
+    def job_count(self):
+        with self._lock:
+            return self._job_count
+
+
+def get_image_size(image_base64):
+    """Width and height of a base64 image, reading only its header"""
+    return Image.open(io.BytesIO(base64.b64decode(image_base64))).size
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def state(self) -> StubState:
+        return self.server.state
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = self.path.split("?")[0].strip("/")
+        if path == "sdapi/v1/progress":
+            self.send_json({"progress": 0.0, "eta_relative": 0.0,
+                            "state": {"job_count": self.state.job_count, "interrupted": False}})
+        elif path == "sdapi/v1/options":
+            self.send_json(self.state.options)
+        else:
+            self.send_json({"detail": "Not Found"}, status=404)
+
+    def do_POST(self):
+        path = self.path.split("?")[0].strip("/")
+        payload = self.read_json()
+
+        if path in ("sdapi/v1/txt2img", "sdapi/v1/img2img"):
+            self.generate(payload)
+        elif path == "sdapi/v1/extra-batch-images":
+            self.upscale(payload)
+        elif path == "sdapi/v1/options":
+            if payload.get("sd_model_checkpoint", self.state.options["sd_model_checkpoint"]) \
+                    != self.state.options["sd_model_checkpoint"]:
+                self.state.run_on_gpu(self.state.switch_latency)
+            self.state.options.update(payload)
+            self.send_json(None)
+        elif path == "sdapi/v1/interrogate":
+            self.state.run_on_gpu(self.state.latency)
+            self.send_json({"caption": "a stub caption"})
+        elif path == "sdapi/v1/interrupt":
+            self.state.interrupt()
+            self.send_json(None)
+        else:
+            self.send_json({"detail": "Not Found"}, status=404)
+
+    def generate(self, payload):
+        width, height = int(payload.get("width") or 512), int(payload.get("height") or 512)
+        images = int(payload.get("batch_size") or 1) * int(payload.get("n_iter") or 1)
+        seed = int(payload.get("seed") or -1)
+
+        self.state.run_on_gpu(self.state.get_generation_seconds(width, height, images))
+
+        image = self.state.get_image(width, height)
+        seeds = [seed + index if seed >= 0 else index for index in range(images)]
+        self.send_json({
+            "images": [image] * images,
+            "parameters": {key: value for key, value in payload.items() if key not in ("init_images", "mask")},
+            "info": json.dumps({"seed": seeds[0], "all_seeds": seeds}),
+        })
+
+    def upscale(self, payload):
+        image_list = payload.get("imageList") or []
+        resize = float(payload.get("upscaling_resize") or 2)
+        sizes = [get_image_size(image["data"]) for image in image_list]
+        sizes = [(int(width * resize), int(height * resize)) for width, height in sizes]
+
+        self.state.run_on_gpu(sum(self.state.get_generation_seconds(width, height, 1) for width, height in sizes))
+
+        self.send_json({
+            "html_info": "",
+            "images": [self.state.get_image(width, height) for width, height in sizes],
+        })
+
+
+def create_server(host="127.0.0.1", port=0, **state_options):
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.state = StubState(**state_options)
+    return server
+
+
+def _serve(host, port, state_options, ready):
+    server = create_server(host, port, **state_options)
+    ready.send(server.server_address[1])
+    ready.close()
+    server.serve_forever()
+
+
+def start_stub_process(host="127.0.0.1", port=0, **state_options):
+    """
+    Runs a stub server in its own process, so its json encoding doesn't compete with the process being
+    measured for the GIL. Returns the process and the server's url
+    """
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_serve, args=(host, port, state_options, sender), daemon=True)
+    process.start()
+    port = receiver.recv()
+    return process, f"http://{host}:{port}"
+
+
+def add_stub_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per generation request")
+    parser.add_argument("--latency-per-megapixel", type=float, default=0.02,
+                        help="Extra generation seconds per output megapixel")
+    parser.add_argument("--switch-latency", type=float, default=0.5, help="Seconds to switch checkpoints")
+    parser.add_argument("--gpu-slots", type=int, default=1, help="Generations a server runs at once")
+    parser.add_argument("--image-format", default="PNG", choices=["PNG", "JPEG"])
+
+
+def get_stub_options(args):
+    return {
+        "latency": args.latency,
+        "latency_per_megapixel": args.latency_per_megapixel,
+        "switch_latency": args.switch_latency,
+        "gpu_slots": args.gpu_slots,
+        "image_format": args.image_format,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub SD WebUI server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7860)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    server = create_server(args.host, args.port, **get_stub_options(args))
+    print(f"Stub SD WebUI on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
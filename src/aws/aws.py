@@ -1,14 +1,24 @@
+import io
 import os
 import boto3
 import uuid
 import mimetypes
+import threading
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from src.common.constants import R2Mapping
-from src.config import R2_ENABLED
+from src.config import R2_ENABLED, S3_MAX_POOL_CONNECTIONS, S3_MULTIPART_THRESHOLD, S3_MULTIPART_CONCURRENCY
 
 from src.common.logger import get_logger
 
 logger = get_logger(__name__)
 
+_mime_types = mimetypes.MimeTypes()
+_s3_client = None
+_s3_client_lock = threading.Lock()
+_transfer_config = TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD,
+                                  max_concurrency=S3_MULTIPART_CONCURRENCY)
+
 def get_file_extension(filename:str)->str:
     return os.path.splitext(filename)[1]
 
@@ -50,17 +60,18 @@ class AWS(object):
             self.__session = self.__get_session()
         return self.__session
 
-    def get_s3_client(self, region=None):
+    def get_s3_client(self, region=None, client_config=None):
         if self.__session is None:
             self.__session = self.__get_session()
 
         if os.environ.get('IN_LAMBDA', 'false') == 'true':
             logger.info('IN_LAMBDA')
 
-            return self.__session.client("s3")
+            return self.__session.client("s3", config=client_config)
 
         key, secret, region = self.__get_key_secret_region(region=region)
-        return self.__session.client("s3", aws_access_key_id=key, aws_secret_access_key=secret, region_name=region)
+        return self.__session.client("s3", aws_access_key_id=key, aws_secret_access_key=secret, region_name=region,
+                                     config=client_config)
 
     def get_s3_resource(self):
         if self.__session is None:
@@ -74,28 +85,54 @@ def get_aws_session():
 
 
 def get_s3_client():
-    return AWS().get_s3_client()
+    """
+    Returns the S3 client shared by all threads, created once with a connection pool sized for concurrent
+    uploads. Clients are thread-safe but the boto3 session creating them isn't, hence the lock
+    """
+    global _s3_client
+
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = AWS().get_s3_client(client_config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
+    return _s3_client
 
 
 def get_s3_resource():
     return AWS().get_s3_resource()
 
+def get_upload_extra_args(content_type=None, public=False):
+    extra_args = {}
+    if content_type is not None:
+        extra_args["ContentType"] = content_type
+    if public is True:
+        extra_args["ACL"] = "public-read"
+    return extra_args
+
 def upload_to_s3(filename, bucket, key=None, public=False):
     s3 = get_s3_client()
     if not os.path.exists(filename):
         raise FileNotFoundError(filename)
-    content_type = mimetypes.MimeTypes().guess_type(filename)[0]
+    content_type = _mime_types.guess_type(filename)[0]
     if key is None:
         key = str(uuid.uuid4()) + get_file_extension(filename)
-    extra_args = {}
-    if content_type is not None:
-        extra_args["ContentType"] = content_type
-    if public is True:
-        extra_args["ACL"] = "public-read"
-    s3.upload_file(filename, bucket, key, ExtraArgs=extra_args)
+    extra_args = get_upload_extra_args(content_type=content_type, public=public)
+    s3.upload_file(filename, bucket, key, ExtraArgs=extra_args, Config=_transfer_config)
     logger.debug("Uploaded %s to %s with key: %s", filename, bucket, key)
     return key
 
+def upload_fileobj_to_s3(fileobj, bucket, key, content_type=None, public=False):
+    """Uploads a file-like object without touching the disk. content_type defaults to a guess from the key"""
+    s3 = get_s3_client()
+    if content_type is None:
+        content_type = _mime_types.guess_type(key)[0]
+    extra_args = get_upload_extra_args(content_type=content_type, public=public)
+    s3.upload_fileobj(fileobj, bucket, key, ExtraArgs=extra_args, Config=_transfer_config)
+    logger.debug("Uploaded in-memory object to %s with key: %s", bucket, key)
+    return key
+
+def upload_bytes_to_s3(data: bytes, bucket, key, content_type=None, public=False):
+    return upload_fileobj_to_s3(io.BytesIO(data), bucket, key, content_type=content_type, public=public)
+
 def s3_public_url(bucket: str, key: str) -> str:
     if R2_ENABLED is True:
         cloudfront_url = R2Mapping[bucket]
@@ -1,14 +1,33 @@
 import os
 import pika
 import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import partial
 
 from src.common.logger import get_logger
-from src.config import RABBIT_URL
+from src.common.metrics import ioloop_lag, time_stage
+from src.config import (RABBIT_URL, AMQP_PUBLISHER_POOL_ENABLED, AMQP_PUBLISHER_POOL_SIZE, AMQP_PUBLISHER_CONFIRMS,
+                        AMQP_PUBLISHER_RETRIES, AMQP_DISPATCH_WORKERS, AMQP_IOLOOP_LAG_INTERVAL)
+
+try:
+    # Optional - a lot faster than json on the large base64 payloads some messages carry
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = get_logger(__name__)
 
 
+def decode_message(body):
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
 def get_amqp_connection(amqp_url=None):
     if amqp_url is None:
         amqp_url = RABBIT_URL
@@ -18,30 +37,194 @@ def get_amqp_connection(amqp_url=None):
     return connection
 
 
-def publish_message(channel, exchange, routing_key, message, priority=0):
+def publish_message(channel, exchange, routing_key, message, priority=0, headers=None):
     channel.basic_publish(exchange=exchange, routing_key=routing_key, body=message,
-                          properties=pika.BasicProperties(delivery_mode=2, priority=priority))
+                          properties=pika.BasicProperties(delivery_mode=2, priority=priority, headers=headers))
+
+
+class PublishNotConfirmedError(Exception):
+    """Raised when the broker does not confirm (nacks/returns) a published message."""
+
+
+class AmqpPublisher(object):
+    """Thread-safe publisher backed by a pool of long-lived blocking connections.
+
+    BlockingConnection is not thread-safe, so every publishing thread borrows its own
+    connection/channel pair from the pool and returns it afterwards. Broken connections are
+    dropped and re-opened on the next borrow. With confirm_delivery=True each channel is put in
+    publisher confirm mode and a message only counts as published once the broker acks it.
+    """
+
+    def __init__(self, amqp_url=None, pool_size=AMQP_PUBLISHER_POOL_SIZE, confirm_delivery=AMQP_PUBLISHER_CONFIRMS,
+                 retries=AMQP_PUBLISHER_RETRIES):
+        self._url = amqp_url or RABBIT_URL
+        self._confirm_delivery = confirm_delivery
+        self._retries = retries
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def _open(self):
+        connection = get_amqp_connection(self._url)
+        channel = connection.channel()
+        if self._confirm_delivery:
+            channel.confirm_delivery()
+        logger.info('Opened publisher connection')
+        return connection, channel
+
+    @staticmethod
+    def _close(connection):
+        try:
+            if connection.is_open:
+                connection.close()
+        except Exception as e:
+            logger.warning(f'Error closing publisher connection: {e}')
+
+    @staticmethod
+    def _is_usable(connection, channel):
+        try:
+            if not (connection.is_open and channel.is_open):
+                return False
+            # Services heartbeats and surfaces a connection the broker closed while idle
+            connection.process_data_events(time_limit=0)
+            return connection.is_open and channel.is_open
+        except Exception:
+            return False
+
+    @contextmanager
+    def _borrow(self):
+        self._slots.acquire()
+        try:
+            connection, channel = None, None
+            try:
+                connection, channel = self._idle.get_nowait()
+            except queue.Empty:
+                pass
+
+            if connection is not None and not self._is_usable(connection, channel):
+                self._close(connection)
+                connection = None
+
+            if connection is None:
+                connection, channel = self._open()
+
+            try:
+                yield channel
+            except Exception:
+                self._close(connection)
+                raise
+            else:
+                self._idle.put((connection, channel))
+        finally:
+            self._slots.release()
+
+    def _basic_publish(self, channel, exchange, routing_key, body, properties):
+        # pika<1.0 returns False on nack/return in confirm mode, pika>=1.0 raises instead
+        delivered = channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body,
+                                          properties=properties)
+        if self._confirm_delivery and delivered is False:
+            raise PublishNotConfirmedError(f'Message to {exchange}/{routing_key} was not confirmed by the broker')
+
+    def publish_batch(self, messages):
+        """Publishes (exchange, routing_key, body, properties) tuples over a single borrowed channel.
+        On a connection/channel error the remaining messages are retried on a fresh connection.
+        """
+        messages = list(messages)
+        published = 0
+        attempt = 0
+
+        while published < len(messages):
+            try:
+                with self._borrow() as channel:
+                    for exchange, routing_key, body, properties in messages[published:]:
+                        self._basic_publish(channel, exchange, routing_key, body, properties)
+                        published += 1
+
+            except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+                attempt += 1
+                if attempt > self._retries:
+                    raise
+                logger.warning(f'Publish failed after {published}/{len(messages)} messages, reconnecting: {e}')
+
+        return published
+
+    def publish(self, exchange, routing_key, body, properties):
+        self.publish_batch([(exchange, routing_key, body, properties)])
+
+    def close(self):
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close(connection)
+
+
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+
+def get_publisher(amqp_url=None):
+    amqp_url = amqp_url or RABBIT_URL
+
+    with _publishers_lock:
+        publisher = _publishers.get(amqp_url)
+        if publisher is None:
+            publisher = AmqpPublisher(amqp_url)
+            _publishers[amqp_url] = publisher
+
+    return publisher
 
 
 def publish_delayed_message(exchange_name, routing_key, data, delay, priority=None):
+    message = json.dumps(data)
+    properties = pika.BasicProperties(delivery_mode=2, headers={"x-delay": f"{delay}"}, priority=priority)
+
+    if AMQP_PUBLISHER_POOL_ENABLED:
+        get_publisher().publish(exchange_name, routing_key, message, properties)
+        return
+
     connection = get_amqp_connection()
     try:
         channel = connection.channel()
-        message = json.dumps(data)
-        channel.basic_publish(exchange_name, routing_key, message,
-                              properties=pika.BasicProperties(delivery_mode=2, headers={"x-delay": f"{delay}"}, priority=priority))
+        channel.basic_publish(exchange_name, routing_key, message, properties=properties)
+    finally:
+        connection.close()
+
+
+def publish(exchange_name, routing_key, data, amqp_url=None, priority=0, headers=None):
+    message = json.dumps(data)
+
+    if AMQP_PUBLISHER_POOL_ENABLED:
+        properties = pika.BasicProperties(delivery_mode=2, priority=priority, headers=headers)
+        get_publisher(amqp_url).publish(exchange_name, routing_key, message, properties)
+        return
+
+    connection = get_amqp_connection(amqp_url)
+    try:
+        channel = connection.channel()
+        publish_message(channel, exchange_name, routing_key, message, priority, headers)
     finally:
         connection.close()
 
 
-def publish(exchange_name, routing_key, data, amqp_url=None, priority=0):
+def publish_many(exchange_name, messages, amqp_url=None):
+    """Publishes a list of (routing_key, data, priority) tuples in one batch."""
+    batch = [
+        (exchange_name, routing_key, json.dumps(data), pika.BasicProperties(delivery_mode=2, priority=priority))
+        for routing_key, data, priority in messages
+    ]
+
+    if AMQP_PUBLISHER_POOL_ENABLED:
+        return get_publisher(amqp_url).publish_batch(batch)
+
     connection = get_amqp_connection(amqp_url)
     try:
         channel = connection.channel()
-        message = json.dumps(data)
-        publish_message(channel, exchange_name, routing_key, message, priority)
+        for exchange, routing_key, body, properties in batch:
+            channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
     finally:
         connection.close()
+    return len(batch)
 
 
 def declare_exchange(channel, exchange_name, exchange_type='topic', durable=True):
@@ -100,11 +283,18 @@ class QueueConsumer(object):
 
     """
 
-    def __init__(self, amqp_url, queue_name, callback):
+    def __init__(self, amqp_url, queue_name, callback, prefetch_count=1,
+                 dispatch_workers=AMQP_DISPATCH_WORKERS, lag_interval=AMQP_IOLOOP_LAG_INTERVAL):
         """Create a new instance of the consumer class, passing in the AMQP
         URL used to connect to RabbitMQ.
 
         :param str amqp_url: The AMQP url to connect with
+        :param int prefetch_count: Max number of unacknowledged messages the
+            broker will deliver to this consumer
+        :param int dispatch_workers: Threads decoding deliveries and calling
+            the callback, one keeps them in delivery order
+        :param float lag_interval: Seconds between the timers measuring the
+            IO loop lag, 0 to not measure it
 
         """
         self._connection = None
@@ -114,6 +304,11 @@ class QueueConsumer(object):
         self._url = amqp_url
         self._queue_name = queue_name
         self._callback = callback
+        self._prefetch_count = prefetch_count
+        self._paused = False
+        self._dispatcher = ThreadPoolExecutor(max_workers=max(1, dispatch_workers),
+                                              thread_name_prefix='amqp-dispatch')
+        self._lag_interval = lag_interval
 
     def connect(self):
         """This method connects to RabbitMQ, returning the connection handle.
@@ -138,6 +333,7 @@ class QueueConsumer(object):
         """
         logger.info('Connection opened')
         self.add_on_connection_close_callback()
+        self.schedule_lag_timer(self._connection)
         self.open_channel()
 
     def add_on_connection_close_callback(self):
@@ -159,6 +355,7 @@ class QueueConsumer(object):
 
         """
         self._channel = None
+        self._consumer_tag = None
         if self._closing:
             self._connection.ioloop.stop()
         else:
@@ -181,6 +378,25 @@ class QueueConsumer(object):
             # There is now a new connection, needs a new ioloop to run
             self._connection.ioloop.start()
 
+    def schedule_lag_timer(self, connection):
+        """Add a timer to the connection's IOLoop that records how late it
+        fires in the IO loop lag histogram and then adds the next one. A late
+        timer means something blocked the IO loop, delaying deliveries, acks
+        and heartbeats.
+
+        """
+        if self._lag_interval <= 0 or self._closing:
+            return
+        connection.add_timeout(self._lag_interval,
+                               partial(self.on_lag_timer, connection, time.monotonic() + self._lag_interval))
+
+    def on_lag_timer(self, connection, expected_at):
+        if connection is not self._connection:
+            # Timer of a connection replaced by reconnect
+            return
+        ioloop_lag.observe(max(0.0, time.monotonic() - expected_at))
+        self.schedule_lag_timer(connection)
+
     def open_channel(self):
         """Open a new channel with RabbitMQ by issuing the Channel.Open RPC
         command. When RabbitMQ responds that the channel is open, the
@@ -226,6 +442,9 @@ class QueueConsumer(object):
         """
         logger.warning('Channel %i was closed: (%s) %s',
                        channel, reply_code, reply_text)
+        # Consuming starts over on the channel of the next connection
+        self._channel = None
+        self._consumer_tag = None
         self._connection.close()
 
     def start_consuming(self):
@@ -240,7 +459,10 @@ class QueueConsumer(object):
         """
         logger.info('Issuing consumer related RPC commands')
         self.add_on_cancel_callback()
-        self._channel.basic_qos(prefetch_count=1)
+        self._channel.basic_qos(prefetch_count=self._prefetch_count)
+        if self._paused:
+            logger.info('Consuming is paused, not issuing Basic.Consume')
+            return
         self._consumer_tag = self._channel.basic_consume(self.on_message,
                                                          self._queue_name)
 
@@ -273,6 +495,9 @@ class QueueConsumer(object):
         instance of BasicProperties with the message properties and the body
         is the message that was sent.
 
+        Decoding and calling the callback are left to the dispatch threads,
+        see dispatch_message, so a large body doesn't stall the IO loop.
+
         :param pika.channel.Channel unused_channel: The channel object
         :param pika.Spec.Basic.Deliver: basic_deliver method
         :param pika.Spec.BasicProperties: properties
@@ -281,10 +506,50 @@ class QueueConsumer(object):
         """
         # logger.info('Received message # %s from %s: %s',
         #             basic_deliver.delivery_tag, properties.app_id, body)
-        params = json.loads(body)
+        self._dispatcher.submit(self.dispatch_message, basic_deliver, properties, body)
+
+    def dispatch_message(self, basic_deliver, properties, body):
+        """Decode a delivery and pass it to the callback, on a dispatch
+        thread. Deliveries that are not a JSON object, or that the callback
+        raises on, are rejected without requeueing, as they would fail again.
+
+        """
+        try:
+            with time_stage('message_decode'):
+                params = decode_message(body)
+            if not isinstance(params, dict):
+                raise ValueError(f'expected a JSON object, got {type(params).__name__}')
+
+        except Exception as e:
+            logger.error(f'Rejecting message with delivery_tag={basic_deliver.delivery_tag} - cannot decode it. E:{e}')
+            self.reject_threadsafe(basic_deliver)
+            return
+
         params['queue_consumer'] = self
         params['basic_deliver'] = basic_deliver
-        self._callback(params)
+        params['basic_properties'] = properties
+        try:
+            self._callback(params)
+
+        except Exception as e:
+            logger.error(f'Rejecting message with delivery_tag={basic_deliver.delivery_tag}. E:{e}', exc_info=True)
+            self.reject_threadsafe(basic_deliver)
+
+    def reject_threadsafe(self, basic_deliver):
+        self._connection.add_callback_threadsafe(partial(self.reject_message, basic_deliver.delivery_tag))
+
+    def reject_message(self, delivery_tag):
+        """Reject the message delivery from RabbitMQ without requeueing it by
+        sending a Basic.Reject RPC method for the delivery tag.
+
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+
+        """
+        if self._channel is None:
+            logger.warning('Channel closed, not rejecting message %s - it will be redelivered', delivery_tag)
+            return
+        logger.warning('Rejecting message %s', delivery_tag)
+        self._channel.basic_reject(delivery_tag, requeue=False)
 
     def add_callback_threadsafe(self, basic_deliver):
         callback = partial(QueueConsumer.on_message_callback, self, basic_deliver)
@@ -301,15 +566,59 @@ class QueueConsumer(object):
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
 
         """
+        if self._channel is None:
+            logger.warning('Channel closed, not acknowledging message %s - it will be redelivered', delivery_tag)
+            return
         logger.info('Acknowledging message %s', delivery_tag)
         self._channel.basic_ack(delivery_tag)
 
+    def pause_consuming(self):
+        """Stop receiving new deliveries without closing the channel, so the
+        messages already being processed can still be acknowledged. Safe to
+        call from any thread.
+
+        The flag is set right away, so a channel opened after a reconnect
+        doesn't consume even if the IOLoop callback went to the old connection.
+
+        """
+        self._paused = True
+        if self._connection is not None:
+            self._connection.add_callback_threadsafe(self._pause_consuming)
+
+    def _pause_consuming(self):
+        if self._paused and self._channel and self._consumer_tag:
+            logger.warning('Pausing consumption - sending a Basic.Cancel RPC command to RabbitMQ')
+            self._channel.basic_cancel(self.on_pause_cancelok, self._consumer_tag)
+            self._consumer_tag = None
+
+    def on_pause_cancelok(self, unused_frame):
+        logger.info('RabbitMQ acknowledged pausing the consumer')
+
+    def resume_consuming(self):
+        """Start receiving deliveries again after pause_consuming. Safe to call
+        from any thread.
+
+        """
+        self._paused = False
+        if self._connection is not None:
+            self._connection.add_callback_threadsafe(self._resume_consuming)
+
+    def _resume_consuming(self):
+        if not self._paused and self._channel and self._consumer_tag is None:
+            logger.info('Resuming consumption - issuing Basic.Consume')
+            self._consumer_tag = self._channel.basic_consume(self.on_message,
+                                                             self._queue_name)
+
     def stop_consuming(self):
         """Tell RabbitMQ that you would like to stop consuming by sending the
         Basic.Cancel RPC command.
 
         """
         if self._channel:
+            if self._consumer_tag is None:
+                # Paused - there is no consumer to cancel
+                self.close_channel()
+                return
             logger.info('Sending a Basic.Cancel RPC command to RabbitMQ')
             self._channel.basic_cancel(self.on_cancelok, self._consumer_tag)
 
@@ -356,6 +665,7 @@ class QueueConsumer(object):
         self._closing = True
         self.stop_consuming()
         self._connection.ioloop.start()
+        self._dispatcher.shutdown(wait=False)
         logger.info('Stopped')
 
     def close_connection(self):
@@ -0,0 +1,116 @@
+import threading
+import time
+
+from src.common.logger import get_logger
+
+logger = get_logger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """Failure counter for a dependency that is either usable (closed) or not (open).
+
+    The breaker opens after failure_threshold consecutive failures. While open no real work
+    should be sent; instead something probes the dependency (e.g. a health check) and reports
+    the result with record_probe(). The first successful probe moves it to half-open, and
+    success_threshold consecutive successful probes close it again. A failed probe re-opens it.
+
+    on_state_change(breaker, old_state, new_state) is called outside the lock on every transition.
+    """
+
+    def __init__(self, name, failure_threshold=3, success_threshold=2, on_state_change=None):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._success_threshold = success_threshold
+        self._on_state_change = on_state_change
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._consecutive_failures = 0
+        self._consecutive_successes = 0
+        self._failures = 0
+        self._opened = 0
+        self._opened_at = None
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    @property
+    def is_closed(self):
+        return self.state == CLOSED
+
+    def open(self):
+        with self._lock:
+            transition = self._transition(OPEN)
+        self._notify(transition)
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._consecutive_failures += 1
+            self._consecutive_successes = 0
+            transition = None
+            if self._state != OPEN and self._consecutive_failures >= self._failure_threshold:
+                transition = self._transition(OPEN)
+        self._notify(transition)
+
+    def record_probe(self, success):
+        if not success:
+            self.record_failure()
+            return
+
+        with self._lock:
+            self._consecutive_failures = 0
+            self._consecutive_successes += 1
+            transition = None
+            if self._state != CLOSED:
+                if self._consecutive_successes >= self._success_threshold:
+                    transition = self._transition(CLOSED)
+                elif self._state == OPEN:
+                    transition = self._transition(HALF_OPEN)
+        self._notify(transition)
+
+    def _transition(self, new_state):
+        old_state = self._state
+        if old_state == new_state:
+            return None
+
+        self._state = new_state
+        if new_state == OPEN:
+            self._opened += 1
+            self._opened_at = time.monotonic()
+            self._consecutive_successes = 0
+        elif new_state == CLOSED:
+            self._opened_at = None
+            self._consecutive_failures = 0
+        return old_state, new_state
+
+    def _notify(self, transition):
+        if transition is None:
+            return
+
+        old_state, new_state = transition
+        logger.info(f"Circuit breaker {self.name}: {old_state} -> {new_state}")
+        if self._on_state_change is not None:
+            try:
+                self._on_state_change(self, old_state, new_state)
+            except Exception as e:
+                logger.error(f"Circuit breaker {self.name} state change callback failed: {e}", exc_info=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self._state,
+                'failures': self._failures,
+                'consecutive_failures': self._consecutive_failures,
+                'opened': self._opened,
+                'open_seconds': 0 if self._opened_at is None else time.monotonic() - self._opened_at,
+            }
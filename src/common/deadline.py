@@ -0,0 +1,121 @@
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+import src.config as config
+
+DEADLINE_HEADER = 'x-deadline'
+TTL_HEADER = 'x-ttl-seconds'
+
+
+def parse_timestamp(value) -> Optional[float]:
+    """
+    Epoch seconds from epoch seconds/milliseconds (number or string) or an ISO-8601 string, None if unparseable
+    """
+    if value is None or isinstance(value, bool):
+        return None
+
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            try:
+                parsed = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+            except ValueError:
+                return None
+            if parsed.tzinfo is None:
+                parsed = parsed.replace(tzinfo=timezone.utc)
+            return parsed.timestamp()
+
+    if isinstance(value, datetime):
+        return value.timestamp()
+
+    if isinstance(value, (int, float)):
+        # Anything this large is in milliseconds
+        return value / 1000 if value > 1e11 else float(value)
+
+    return None
+
+
+def _parse_seconds(value) -> Optional[float]:
+    try:
+        return float(value) if value is not None and not isinstance(value, bool) else None
+    except (TypeError, ValueError):
+        return None
+
+
+def get_message_deadline(params, properties=None) -> Optional[float]:
+    """
+    Epoch seconds after which nobody waits for the message's result, or None if it has no deadline.
+
+    Looked up in order: the x-deadline header, the x-ttl-seconds header counted from the message
+    timestamp property, callback_message.deadline, callback_message.ttl_seconds counted from
+    callback_message.created_at, and finally MESSAGE_DEFAULT_TTL_SECONDS counted from whichever
+    creation time the message has
+    """
+    headers = getattr(properties, 'headers', None) or {}
+    published_at = parse_timestamp(getattr(properties, 'timestamp', None))
+
+    deadline = parse_timestamp(headers.get(DEADLINE_HEADER))
+    if deadline is not None:
+        return deadline
+
+    ttl_seconds = _parse_seconds(headers.get(TTL_HEADER))
+    if ttl_seconds is not None and published_at is not None:
+        return published_at + ttl_seconds
+
+    callback_message = params.get('callback_message') or {}
+    deadline = parse_timestamp(callback_message.get('deadline'))
+    if deadline is not None:
+        return deadline
+
+    created_at = parse_timestamp(callback_message.get('created_at'))
+    ttl_seconds = _parse_seconds(callback_message.get('ttl_seconds'))
+    if ttl_seconds is not None and created_at is not None:
+        return created_at + ttl_seconds
+
+    created_at = created_at if created_at is not None else published_at
+    if config.MESSAGE_DEFAULT_TTL_SECONDS > 0 and created_at is not None:
+        return created_at + config.MESSAGE_DEFAULT_TTL_SECONDS
+
+    return None
+
+
+def is_expired(deadline: Optional[float], now: Optional[float] = None) -> bool:
+    if deadline is None:
+        return False
+    now = time.time() if now is None else now
+    return now > deadline + config.MESSAGE_DEADLINE_GRACE_SECONDS
+
+
+class DeadlineStats(object):
+    """Counts messages checked against their deadline and the ones shed because it had passed"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checked = 0
+        self._with_deadline = 0
+        self._expired = 0
+        self._expired_seconds = 0.0
+
+    def record(self, deadline, expired, now=None):
+        with self._lock:
+            self._checked += 1
+            if deadline is not None:
+                self._with_deadline += 1
+            if expired:
+                self._expired += 1
+                self._expired_seconds += (time.time() if now is None else now) - deadline
+
+    def stats(self):
+        with self._lock:
+            return {
+                'checked': self._checked,
+                'with_deadline': self._with_deadline,
+                'expired': self._expired,
+                'expired_seconds': self._expired_seconds,
+            }
+
+
+deadline_stats = DeadlineStats()
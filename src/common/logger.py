@@ -1,12 +1,22 @@
+import atexit
 import logging
 import os
+import queue
 import socket
 import sys
-from logging.handlers import RotatingFileHandler
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 PLATFORM_ENV = os.environ.get('PLATFORM_ENV', 'development').lower()
 TEST_MODE = PLATFORM_ENV == "test"
 
+# Run the console and file handlers on a background thread so logging never blocks the caller on I/O.
+# INFO/DEBUG records beyond LOG_QUEUE_SIZE waiting ones are dropped, WARNING and above wait up to
+# LOG_WARNING_PUT_TIMEOUT seconds for room and are written to stderr directly if there is none
+ASYNC_LOGGING = os.environ.get('ASYNC_LOGGING', 'true').lower() == 'true'
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_WARNING_PUT_TIMEOUT = float(os.environ.get('LOG_WARNING_PUT_TIMEOUT', 1))
+
 LOG_FILE = "pencil_model_server.log"
 HOSTNAME = os.environ.get("DOCKER_HOSTNAME", socket.gethostname())
 
@@ -39,33 +49,31 @@ class DistributedLogger(object):
     def silent(self, silent):
         self._silent = silent
 
+    def is_enabled_for(self, level):
+        return not self._silent and self._logger.isEnabledFor(level)
+
+    def _log(self, level, msg, args, kwargs):
+        # Checked before building the message, and args are only formatted if the record is handled
+        if self.is_enabled_for(level):
+            self._logger.log(level, f"{self._tag}::{msg}", *args, **kwargs)
+
     def log(self, level, msg, *args, **kwargs):
         self._logger.log(level, msg, *args, **kwargs)
 
     def info(self, msg, *args, **kwargs):
-        msg = f"{self._tag}::{msg}"
-        if not self._silent:
-            self._logger.info(msg, *args, **kwargs)
+        self._log(logging.INFO, msg, args, kwargs)
 
     def debug(self, msg, *args, **kwargs):
-        msg = f"{self._tag}::{msg}"
-        if not self._silent:
-            self._logger.debug(msg, *args, **kwargs)
+        self._log(logging.DEBUG, msg, args, kwargs)
 
     def error(self, msg, *args, **kwargs):
-        msg = f"{self._tag}::{msg}"
-        if not self._silent:
-            self._logger.error(msg, *args, **kwargs)
+        self._log(logging.ERROR, msg, args, kwargs)
 
     def warn(self, msg, *args, **kwargs):
-        msg = f"{self._tag}::{msg}"
-        if not self._silent:
-            self._logger.warning(msg, *args, **kwargs)
+        self._log(logging.WARNING, msg, args, kwargs)
 
     def warning(self, msg, *args, **kwargs):
-        msg = f"{self._tag}::{msg}"
-        if not self._silent:
-            self._logger.warning(msg, *args, **kwargs)
+        self._log(logging.WARNING, msg, args, kwargs)
 
 
 log_wrapper = DistributedLogger()
@@ -101,25 +109,91 @@ def get_local_file_handler(formatter):
     return file_handler
 
 
-def get_logger(logger_name='log'):
-    root_logger = logging.getLogger(logger_name)
-    root_logger.setLevel(logging.INFO)
+def get_handlers(formatter):
+    handlers = []
+    try:
+        handlers.append(get_file_handler(formatter))
+    except:
+        pass
 
-    if not root_logger.handlers:
-        formatter = get_formatter()
+    handlers.append(get_console_handler(formatter))
 
+    if not TEST_MODE:
         try:
-            root_logger.addHandler(get_file_handler(formatter))
+            handlers.append(get_local_file_handler(formatter))
         except:
             pass
 
-        root_logger.addHandler(get_console_handler(formatter))
+    return handlers
 
-        if not TEST_MODE:
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records to the log listener thread. When it falls behind INFO/DEBUG records are dropped instead of
+    blocking, while warnings and errors are never lost - they are the ones that matter when the worker is overloaded
+    """
+
+    def __init__(self, log_queue, warning_put_timeout=LOG_WARNING_PUT_TIMEOUT):
+        super().__init__(log_queue)
+        self.warning_put_timeout = warning_put_timeout
+        self.dropped = 0
+        self.unqueued = 0
+
+    def enqueue(self, record):
+        if record.levelno < logging.WARNING:
             try:
-                root_logger.addHandler(get_local_file_handler(formatter))
-            except:
-                pass
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+            return
+
+        try:
+            self.queue.put(record, timeout=self.warning_put_timeout)
+        except queue.Full:
+            # Already formatted by prepare(), tracebacks included
+            self.unqueued += 1
+            logging.lastResort.handle(record)
+
+
+_queue_handler = None
+_queue_handler_lock = threading.Lock()
+
+
+def get_queue_handler():
+    """
+    The handler all loggers share in async mode. Its listener thread runs the console and file handlers and
+    is flushed at exit
+    """
+    global _queue_handler
+
+    with _queue_handler_lock:
+        if _queue_handler is None:
+            log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+            listener = QueueListener(log_queue, *get_handlers(get_formatter()), respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+            _queue_handler = NonBlockingQueueHandler(log_queue)
+
+    return _queue_handler
+
+
+def logging_stats():
+    if _queue_handler is None:
+        return {'async': False}
+    return {'async': True, 'queued': _queue_handler.queue.qsize(), 'dropped': _queue_handler.dropped,
+            'unqueued': _queue_handler.unqueued}
+
+
+def get_logger(logger_name='log'):
+    root_logger = logging.getLogger(logger_name)
+    root_logger.setLevel(logging.INFO)
+
+    if not root_logger.handlers:
+        if ASYNC_LOGGING:
+            root_logger.addHandler(get_queue_handler())
+        else:
+            for handler in get_handlers(get_formatter()):
+                root_logger.addHandler(handler)
 
         # with this pattern, it's rarely necessary to propagate the error up to parent
         root_logger.propagate = False
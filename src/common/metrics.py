@@ -0,0 +1,280 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.common.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Job stages range from milliseconds (redis) to minutes (generation on a busy GPU)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def collect(self, const_labels):
+        with self._lock:
+            values = dict(self._values)
+
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for key, value in sorted(values.items()):
+            labels = list(const_labels) + list(zip(self.labelnames, key))
+            lines.extend(self._samples(labels, value))
+        return lines
+
+    def _samples(self, labels, value):
+        return [f'{self.name}{_format_labels(labels)} {_format_value(value)}']
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * (len(self._buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self, const_labels):
+        with self._lock:
+            values = {key: (list(series[0]), series[1], series[2]) for key, series in self._values.items()}
+
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for key, (bucket_counts, total, count) in sorted(values.items()):
+            labels = list(const_labels) + list(zip(self.labelnames, key))
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self._buckets + (float('inf'),), bucket_counts):
+                cumulative += bucket_count
+                bucket_labels = labels + [('le', _format_value(float(upper_bound)))]
+                lines.append(f'{self.name}_bucket{_format_labels(bucket_labels)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(labels)} {count}')
+        return lines
+
+    @contextmanager
+    def time(self, **labels):
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started_at, **labels)
+
+
+def _flatten_stats(stats, prefix=''):
+    for key, value in stats.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            yield from _flatten_stats(value, prefix=f'{name}_')
+        elif isinstance(value, bool):
+            yield name, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, value
+
+
+class Registry(object):
+    """Minimal Prometheus registry rendering the text exposition format.
+
+    Besides counters, gauges and histograms it exposes the stats() dicts of the worker's
+    components (worker pool, caches, coalescer, ...) as one gauge family,
+    <namespace>_component_stat{component=..., stat=...}, read when scraped.
+    """
+
+    def __init__(self, namespace):
+        self._namespace = namespace
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._stats = []
+        self._const_labels = ()
+
+    def set_const_labels(self, **labels):
+        self._const_labels = tuple(sorted(labels.items()))
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(f'{self._namespace}_{name}', documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(f'{self._namespace}_{name}', documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(f'{self._namespace}_{name}', documentation, labelnames, buckets))
+
+    def register_stats(self, component, stats_fn, instance_label=None):
+        """
+        Exposes the numeric values of stats_fn() on every scrape. With instance_label the top level keys of
+        the stats are instances (e.g. backend urls) and go into that label
+        """
+        with self._lock:
+            self._stats.append((component, stats_fn, instance_label))
+
+    def _collect_stats(self):
+        name = f'{self._namespace}_component_stat'
+        lines = [f'# HELP {name} Internal stats of worker components', f'# TYPE {name} gauge']
+
+        with self._lock:
+            stats_sources = list(self._stats)
+
+        for component, stats_fn, instance_label in stats_sources:
+            try:
+                stats = stats_fn()
+            except Exception as e:
+                logger.warning(f"Couldn't collect {component} stats: {e}")
+                continue
+
+            instances = stats.items() if instance_label else [(None, stats)]
+            for instance, instance_stats in instances:
+                if not isinstance(instance_stats, dict):
+                    continue
+                for stat, value in _flatten_stats(instance_stats):
+                    labels = list(self._const_labels) + [('component', component)]
+                    if instance_label:
+                        labels.append((instance_label, instance))
+                    labels.append(('stat', stat))
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+        return lines
+
+    def expose(self):
+        with self._lock:
+            metrics = list(self._metrics)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect(self._const_labels))
+        lines.extend(self._collect_stats())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry('sd_webui_worker')
+
+stage_duration = registry.histogram(
+    'stage_duration_seconds', 'Time spent in each stage of a job', ['stage', 'endpoint'])
+jobs_total = registry.counter(
+    'jobs_total', 'Jobs processed by outcome', ['outcome'])
+ioloop_lag = registry.histogram(
+    'amqp_ioloop_lag_seconds', 'How late timers on the AMQP consumer IO loop fire',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+
+
+_stage_timings = contextvars.ContextVar('stage_timings', default=None)
+
+
+@contextmanager
+def collect_stage_timings():
+    """
+    Yields a list collecting (stage, endpoint, seconds) of the stages observed in the block, including
+    threads it hands work to with run_in_context
+    """
+    timings = []
+    token = _stage_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _stage_timings.reset(token)
+
+
+def observe_stage(seconds, stage, endpoint=''):
+    stage_duration.observe(seconds, stage=stage, endpoint=endpoint)
+    timings = _stage_timings.get()
+    if timings is not None:
+        timings.append((stage, endpoint, seconds))
+
+
+@contextmanager
+def time_stage(stage, endpoint=''):
+    """Context manager observing the duration of a job stage"""
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        observe_stage(time.monotonic() - started_at, stage, endpoint)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host='0.0.0.0'):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info(f"Serving metrics on {host}:{server.server_address[1]}/metrics")
+    return server
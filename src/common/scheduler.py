@@ -0,0 +1,98 @@
+import threading
+import time
+
+from src.common.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class _Entry(object):
+    def __init__(self, item, key):
+        self.item = item
+        self.key = key
+        self.enqueued_at = time.monotonic()
+        self.bypassed = 0
+
+
+class AffinityScheduler(object):
+    """Queue that hands out jobs grouped by an affinity key instead of strictly in arrival order.
+
+    Drop-in for queue.Queue inside WorkerPool (put/get/qsize). Items carry an affinity_key
+    (e.g. the checkpoint a job needs). get() prefers the key of the last job it handed out, then
+    the keys returned by preferred_keys_fn (e.g. the checkpoint currently loaded), and otherwise
+    falls back to the oldest job. Items with no key fit any group. To bound starvation the oldest
+    job is always taken once it waited max_wait_seconds or was overtaken max_bypass times.
+    """
+
+    def __init__(self, preferred_keys_fn=None, max_wait_seconds=60, max_bypass=8):
+        self._preferred_keys_fn = preferred_keys_fn
+        self._max_wait_seconds = max_wait_seconds
+        self._max_bypass = max_bypass
+        self._condition = threading.Condition()
+        self._entries = []
+        self._last_key = None
+        self._reordered = 0
+        self._aged_out = 0
+
+    def put(self, item):
+        with self._condition:
+            self._entries.append(_Entry(item, getattr(item, 'affinity_key', None)))
+            self._condition.notify()
+
+    def get(self):
+        with self._condition:
+            while not self._entries:
+                self._condition.wait()
+
+            index = self._select()
+            entry = self._entries.pop(index)
+            for overtaken in self._entries[:index]:
+                overtaken.bypassed += 1
+
+            if index > 0:
+                self._reordered += 1
+            if entry.key is not None:
+                self._last_key = entry.key
+
+            return entry.item
+
+    def qsize(self):
+        with self._condition:
+            return len(self._entries)
+
+    def _preferred_keys(self):
+        keys = []
+        if self._last_key is not None:
+            keys.append(self._last_key)
+
+        if self._preferred_keys_fn is not None:
+            try:
+                keys.extend(key for key in self._preferred_keys_fn() if key is not None and key not in keys)
+            except Exception as e:
+                logger.warning(f"Couldn't get preferred scheduling keys: {e}")
+
+        return keys
+
+    def _select(self):
+        oldest = self._entries[0]
+        if (time.monotonic() - oldest.enqueued_at >= self._max_wait_seconds
+                or oldest.bypassed >= self._max_bypass):
+            if oldest.key is not None and oldest.key != self._last_key:
+                self._aged_out += 1
+            return 0
+
+        for key in self._preferred_keys():
+            for index, entry in enumerate(self._entries):
+                if entry.key is None or entry.key == key:
+                    return index
+
+        return 0
+
+    def stats(self):
+        with self._condition:
+            return {
+                'pending': len(self._entries),
+                'reordered': self._reordered,
+                'aged_out': self._aged_out,
+                'last_key': self._last_key,
+            }
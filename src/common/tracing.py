@@ -0,0 +1,273 @@
+import contextvars
+import functools
+import json
+import os
+import queue
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+import src.config as config
+from src.common.logger import get_logger
+
+logger = get_logger(__name__)
+
+TRACEPARENT_HEADER = 'traceparent'
+_TRACEPARENT = re.compile(r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def _random_hex(num_bytes):
+    return os.urandom(num_bytes).hex()
+
+
+def parse_traceparent(value):
+    """
+    (trace_id, parent_span_id, sampled) of a W3C traceparent header, None if it's missing or invalid
+    """
+    if not isinstance(value, str):
+        return None
+    match = _TRACEPARENT.match(value.strip().lower())
+    if match is None:
+        return None
+    version, trace_id, span_id, flags = match.groups()
+    if version == 'ff' or trace_id == '0' * 32 or span_id == '0' * 16:
+        return None
+    return trace_id, span_id, bool(int(flags, 16) & 1)
+
+
+class Span(object):
+    def __init__(self, name, trace_id, parent_id=None, sampled=True, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _random_hex(8)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, e):
+        self.error = f"{type(e).__name__}: {e}"
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            if self.sampled:
+                get_exporter().export(self)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_ns': self.start_ns,
+            'end_ns': self.end_ns,
+            'duration_ms': None if self.end_ns is None else (self.end_ns - self.start_ns) / 1e6,
+            'service': config.TRACING_SERVICE_NAME,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+def extract_traceparent(params, properties=None):
+    """
+    Trace context of an incoming message: the traceparent AMQP header, or a traceparent field of the
+    message or of its callback_message
+    """
+    headers = getattr(properties, 'headers', None) or {}
+    return (headers.get(TRACEPARENT_HEADER)
+            or params.get(TRACEPARENT_HEADER)
+            or (params.get('callback_message') or {}).get(TRACEPARENT_HEADER))
+
+
+def current_span():
+    return _current_span.get()
+
+
+def current_traceparent():
+    span = current_span()
+    return None if span is None else span.traceparent
+
+
+@contextmanager
+def start_span(name, attributes=None, traceparent=None):
+    """
+    Runs the block in a new span, a child of the current span, or of traceparent when given (e.g. the
+    context of an incoming message), or a new trace otherwise
+    """
+    parent = current_span()
+    remote_parent = parse_traceparent(traceparent) if traceparent is not None else None
+
+    if remote_parent is not None:
+        trace_id, parent_id, sampled = remote_parent
+    elif parent is not None:
+        trace_id, parent_id, sampled = parent.trace_id, parent.span_id, parent.sampled
+    else:
+        trace_id, parent_id, sampled = _random_hex(16), None, True
+
+    span = Span(name, trace_id, parent_id=parent_id, sampled=sampled, attributes=attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end()
+
+
+def traced(name):
+    """Decorator running the function in a child span. Outside of a trace (e.g. background threads) it adds nothing"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if current_span() is None:
+                return fn(*args, **kwargs)
+            with start_span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def run_in_context(fn):
+    """Wraps fn so it runs in the caller's tracing context when handed to another thread, e.g. an executor"""
+    context = contextvars.copy_context()
+    return functools.partial(context.run, fn)
+
+
+class _NoopExporter(object):
+    def export(self, span):
+        pass
+
+
+class BatchExporter(object):
+    """Hands finished spans to a background thread that writes them in batches, so jobs never wait on export"""
+
+    def __init__(self, write_batch, max_batch_size=256, flush_interval=2.0, max_queue_size=10000):
+        self._write_batch = write_batch
+        self._max_batch_size = max_batch_size
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._dropped = 0
+        self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+        self._thread.start()
+
+    def export(self, span):
+        try:
+            self._queue.put_nowait(span.to_dict())
+        except queue.Full:
+            self._dropped += 1
+
+    def _run(self):
+        while True:
+            batch = []
+            deadline = time.monotonic() + self._flush_interval
+            while len(batch) < self._max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    logger.warning(f"Couldn't export {len(batch)} spans: {e}")
+
+
+def write_jsonl(path, spans):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'a') as f:
+        for span in spans:
+            f.write(json.dumps(span, default=str) + '\n')
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def to_otlp_json(spans):
+    """OTLP/HTTP JSON encoding of exported span dicts"""
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': [
+                {'key': 'service.name', 'value': {'stringValue': config.TRACING_SERVICE_NAME}},
+            ]},
+            'scopeSpans': [{
+                'scope': {'name': __name__},
+                'spans': [
+                    {
+                        'traceId': span['trace_id'],
+                        'spanId': span['span_id'],
+                        'parentSpanId': span['parent_id'] or '',
+                        'name': span['name'],
+                        'kind': 1,
+                        'startTimeUnixNano': str(span['start_ns']),
+                        'endTimeUnixNano': str(span['end_ns']),
+                        'attributes': [
+                            {'key': key, 'value': _otlp_value(value)}
+                            for key, value in span['attributes'].items() if value is not None
+                        ],
+                        'status': {'code': 2, 'message': span['error']} if span['error'] else {'code': 1},
+                    }
+                    for span in spans
+                ],
+            }],
+        }],
+    }
+
+
+def post_otlp(endpoint, spans):
+    request = urllib.request.Request(
+        url=endpoint.rstrip('/') + '/v1/traces',
+        data=json.dumps(to_otlp_json(spans)).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST',
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        response.read()
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter():
+    global _exporter
+
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                if config.TRACING_EXPORTER == 'file':
+                    _exporter = BatchExporter(functools.partial(write_jsonl, config.TRACING_FILE_PATH))
+                elif config.TRACING_EXPORTER == 'otlp':
+                    _exporter = BatchExporter(functools.partial(post_otlp, config.TRACING_OTLP_ENDPOINT))
+                else:
+                    _exporter = _NoopExporter()
+
+    return _exporter
@@ -11,7 +11,7 @@ def sanitize_params_v1(params, hide_jwt=True, hide_list=False):
     sanitized_params = {}
 
     for k, v in params.items():
-        if k in ['queue_consumer', 'basic_deliver']:
+        if k in ['queue_consumer', 'basic_deliver', 'basic_properties']:
             continue
 
         if hide_jwt is True and 'jwt' in k:
@@ -33,7 +33,7 @@ def sanitize_params_v2(params, hide_jwt=True, hide_list=False):
     # Recursively clean up dict (e.g. callback params etc.)
     sanitized_params = {}
     for k, v in params.items():
-        if k in ['queue_consumer', 'basic_deliver']:
+        if k in ['queue_consumer', 'basic_deliver', 'basic_properties']:
             continue
 
         elif hide_jwt is True and 'jwt' in k:
@@ -68,6 +68,57 @@ def sanitize_params_for_print(params, hide_jwt=True, hide_list=False):
     return sanitized_params
 
 
+# Keys containing any of these never leave the worker, e.g. in recorded message corpora
+SECRET_KEY_PARTS = ('jwt', 'secret', 'password', 'api_key', 'authorization', 'access_token', 'auth_token')
+
+
+def redact_params(params, redact_values_of=(), secret_key_parts=SECRET_KEY_PARTS):
+    """
+    Recursively drops secret keys (like hide_jwt of sanitize_params_for_print) and replaces string values of
+    the keys in redact_values_of (e.g. prompts) with a placeholder of the same length. Unlike
+    sanitize_params_for_print nothing is truncated, so the result can still be processed
+    """
+    if isinstance(params, list):
+        return [redact_params(v, redact_values_of, secret_key_parts) for v in params]
+
+    if not isinstance(params, dict):
+        return params
+
+    redacted_params = {}
+    for k, v in params.items():
+        if k in ['queue_consumer', 'basic_deliver', 'basic_properties']:
+            continue
+
+        elif any(part in str(k).lower() for part in secret_key_parts):
+            continue
+
+        elif k in redact_values_of and isinstance(v, str):
+            redacted_params[k] = 'x' * len(v)
+
+        else:
+            redacted_params[k] = redact_params(v, redact_values_of, secret_key_parts)
+
+    return redacted_params
+
+
+class SanitizedParams(object):
+    """
+    Log argument sanitizing params with sanitize_params_for_print when it's first formatted, so it costs nothing
+    below the enabled log level and params logged more than once are sanitized once
+    """
+
+    def __init__(self, params, hide_jwt=True, hide_list=False):
+        self._params = params
+        self._hide_jwt = hide_jwt
+        self._hide_list = hide_list
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            self._text = str(sanitize_params_for_print(self._params, hide_jwt=self._hide_jwt, hide_list=self._hide_list))
+        return self._text
+
+
 def print_sanitized_params(params, hide_jwt=True, hide_list=False):
     sanitized_params = sanitize_params_for_print(
         params, hide_jwt=hide_jwt, hide_list=hide_list)
@@ -0,0 +1,152 @@
+import queue
+import threading
+import time
+
+from threading import Thread
+
+from src.common.logger import get_logger
+
+logger = get_logger(__name__)
+
+_STOP = object()
+
+
+class SlotStats(object):
+    """Running totals for a single worker slot (thread) of the pool."""
+
+    def __init__(self, slot):
+        self.slot = slot
+        self.busy = False
+        self.jobs = 0
+        self.failures = 0
+        self.total_queue_wait = 0.0
+        self.total_run_time = 0.0
+        self.last_queue_wait = 0.0
+        self.last_run_time = 0.0
+
+    def record(self, queue_wait, run_time, failed=False):
+        self.jobs += 1
+        if failed:
+            self.failures += 1
+        self.total_queue_wait += queue_wait
+        self.total_run_time += run_time
+        self.last_queue_wait = queue_wait
+        self.last_run_time = run_time
+
+    def as_dict(self):
+        jobs = max(self.jobs, 1)
+        return {
+            'slot': self.slot,
+            'busy': self.busy,
+            'jobs': self.jobs,
+            'failures': self.failures,
+            'total_queue_wait': self.total_queue_wait,
+            'total_run_time': self.total_run_time,
+            'avg_queue_wait': self.total_queue_wait / jobs,
+            'avg_run_time': self.total_run_time / jobs,
+            'last_queue_wait': self.last_queue_wait,
+            'last_run_time': self.last_run_time,
+        }
+
+
+class _Job(object):
+    def __init__(self, fn, args, kwargs, affinity_key=None):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.affinity_key = affinity_key
+        self.submitted_at = time.monotonic()
+
+
+class WorkerPool(object):
+    """Fixed number of worker threads ("slots") running submitted jobs.
+
+    At most max_workers jobs run at the same time. Pair this with an AMQP prefetch count of
+    max_workers so the broker never delivers more messages than there are free slots.
+    Jobs run in arrival order unless a job_queue with a different policy (e.g. AffinityScheduler)
+    is given. Queue wait (submit -> start) and run time are tracked per slot, see stats().
+    """
+
+    def __init__(self, max_workers, name='worker', job_queue=None):
+        assert max_workers > 0, "max_workers must be > 0"
+
+        self._max_workers = max_workers
+        self._name = name
+        self._queue = job_queue if job_queue is not None else queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._slot_stats = [SlotStats(slot) for slot in range(max_workers)]
+        self._started = False
+
+    @property
+    def max_workers(self):
+        return self._max_workers
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+            for slot in range(self._max_workers):
+                th = Thread(target=self._run_slot, args=(slot,), name=f'{self._name}-slot-{slot}', daemon=False)
+                th.start()
+                self._threads.append(th)
+
+        logger.info(f"Started worker pool '{self._name}' with {self._max_workers} slots")
+
+    def submit(self, fn, *args, affinity_key=None, **kwargs):
+        if not self._started:
+            self.start()
+        self._queue.put(_Job(fn, args, kwargs, affinity_key=affinity_key))
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            slots = [slot_stats.as_dict() for slot_stats in self._slot_stats]
+        return {
+            'max_workers': self._max_workers,
+            'pending': self.pending(),
+            'busy': sum(1 for slot in slots if slot['busy']),
+            'slots': slots,
+        }
+
+    def shutdown(self, wait=True):
+        logger.info(f"Shutting down worker pool '{self._name}'")
+        for _ in self._threads:
+            self._queue.put(_STOP)
+
+        if wait:
+            for th in self._threads:
+                th.join()
+
+    def _run_slot(self, slot):
+        slot_stats = self._slot_stats[slot]
+
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            started_at = time.monotonic()
+            queue_wait = started_at - item.submitted_at
+
+            with self._lock:
+                slot_stats.busy = True
+
+            failed = False
+            try:
+                item.fn(*item.args, **item.kwargs)
+            except Exception as e:
+                failed = True
+                logger.error(f"Job failed in slot {slot}: {e}", exc_info=True)
+            finally:
+                run_time = time.monotonic() - started_at
+                with self._lock:
+                    slot_stats.busy = False
+                    slot_stats.record(queue_wait, run_time, failed=failed)
+
+                logger.info(f"Slot {slot} finished job - queue wait: {queue_wait:.3f}s, run time: {run_time:.3f}s")
+
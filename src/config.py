@@ -18,10 +18,67 @@ except Exception as e:
 
 DELAY_EXCHANGE_NAME = os.environ.get('DELAY_EXCHANGE_NAME')
 
+# Publishing re-uses a small pool of long-lived connections instead of one connection per message
+AMQP_PUBLISHER_POOL_ENABLED = os.environ.get('AMQP_PUBLISHER_POOL_ENABLED', 'true').lower() == 'true'
+AMQP_PUBLISHER_POOL_SIZE = int(os.environ.get('AMQP_PUBLISHER_POOL_SIZE', 4))
+AMQP_PUBLISHER_CONFIRMS = os.environ.get('AMQP_PUBLISHER_CONFIRMS', 'true').lower() == 'true'
+AMQP_PUBLISHER_RETRIES = int(os.environ.get('AMQP_PUBLISHER_RETRIES', 1))
+# Deliveries are decoded (with orjson when installed) and handed to the worker on these threads, so pika's
+# IO loop only receives them and keeps heartbeats and acks flowing
+AMQP_DISPATCH_WORKERS = int(os.environ.get('AMQP_DISPATCH_WORKERS', 1))
+# A timer on the consumer's IO loop fires this often to measure how late it runs, 0 = off
+AMQP_IOLOOP_LAG_INTERVAL = float(os.environ.get('AMQP_IOLOOP_LAG_INTERVAL', 1))
+
 SD_WEBUI_API_ENDPOINT = os.environ.get("SD_WEBUI_API_ENDPOINT", "http://localhost:7860")
 BATCH_UPSCALE_ENDPOINT = "sdapi/v1/extra-batch-images/"
 SET_SD_WEBUI_OPTIONS_ENDPOINT = "sdapi/v1/options/"
 SD_WEBUI_INTERROGATE_ENDPOINT = "sdapi/v1/interrogate/"
+SD_WEBUI_PROGRESS_ENDPOINT = "sdapi/v1/progress"
+SD_WEBUI_INTERRUPT_ENDPOINT = "sdapi/v1/interrupt"
+
+# Comma separated SD WebUI servers this worker routes jobs across. Defaults to SD_WEBUI_API_ENDPOINT alone,
+# also when set but empty
+SD_WEBUI_API_ENDPOINTS = [
+    endpoint.strip() for endpoint in
+    (os.environ.get("SD_WEBUI_API_ENDPOINTS") or SD_WEBUI_API_ENDPOINT).split(",")
+    if endpoint.strip()
+]
+SD_WEBUI_HEALTH_CHECK_INTERVAL = float(os.environ.get("SD_WEBUI_HEALTH_CHECK_INTERVAL", 10))
+# A backend stops getting jobs after this many consecutive failed jobs or health checks,
+# and gets them again after this many consecutive successful health checks
+SD_WEBUI_EJECT_AFTER_FAILURES = int(os.environ.get("SD_WEBUI_EJECT_AFTER_FAILURES", 3))
+SD_WEBUI_READMIT_AFTER_SUCCESSES = int(os.environ.get("SD_WEBUI_READMIT_AFTER_SUCCESSES", 2))
+# Prefer a backend with the job's checkpoint loaded while it has at most this many more jobs than the least busy one
+SD_WEBUI_CHECKPOINT_AFFINITY_SLACK = int(os.environ.get("SD_WEBUI_CHECKPOINT_AFFINITY_SLACK", 1))
+
+# Merge identical txt2img/img2img requests from concurrent jobs into one call with a bigger batch_size.
+# Disabled while the window is 0 - only useful with WORKER_EXECUTION_MODE=pool and WORKER_CONCURRENCY > 1
+SD_WEBUI_COALESCE_WINDOW_MS = int(os.environ.get("SD_WEBUI_COALESCE_WINDOW_MS", 0))
+SD_WEBUI_COALESCE_MAX_BATCH_SIZE = int(os.environ.get("SD_WEBUI_COALESCE_MAX_BATCH_SIZE", 8))
+SD_WEBUI_COALESCE_ENDPOINTS = [
+    endpoint.strip().strip("/") for endpoint in
+    os.environ.get("SD_WEBUI_COALESCE_ENDPOINTS", "sdapi/v1/txt2img,sdapi/v1/img2img").split(",")
+    if endpoint.strip()
+]
+
+# Decode the images of txt2img/img2img/upscale responses incrementally instead of response.json()
+SD_WEBUI_STREAMING_RESPONSE = os.environ.get("SD_WEBUI_STREAMING_RESPONSE", "true").lower() == "true"
+SD_WEBUI_STREAM_CHUNK_SIZE = int(os.environ.get("SD_WEBUI_STREAM_CHUNK_SIZE", 256 * 1024))
+
+# Downscale init images, masks and ControlNet images to cover the requested width/height before posting them.
+# Comma separated endpoints it applies to, empty disables it
+INPUT_IMAGE_DOWNSCALE_ENDPOINTS = [
+    endpoint.strip().strip("/") for endpoint in
+    os.environ.get("INPUT_IMAGE_DOWNSCALE_ENDPOINTS", "").split(",")
+    if endpoint.strip()
+]
+# Only downscale inputs at least this many times larger than needed, to avoid re-encoding for little gain
+INPUT_IMAGE_DOWNSCALE_MIN_RATIO = float(os.environ.get("INPUT_IMAGE_DOWNSCALE_MIN_RATIO", 1.25))
+
+# Upscale in chunks of this many images (0 = all images in one request), with bounded concurrency
+UPSCALE_CHUNK_SIZE = int(os.environ.get("UPSCALE_CHUNK_SIZE", 0))
+UPSCALE_MAX_CONCURRENCY = int(os.environ.get("UPSCALE_MAX_CONCURRENCY", 1))
+UPSCALE_CHUNK_RETRIES = int(os.environ.get("UPSCALE_CHUNK_RETRIES", 1))
 
 # Be very aggressive on this so we don't waste time
 SERVER_CHECK_INITIAL_DELAY=1
@@ -33,10 +90,77 @@ SERVER_POST_RETRIES=3
 SERVER_POST_BACKOFF=1
 SERVER_POST_TIMEOUT=600
 
+# Derive POST timeouts from the latency observed per endpoint instead of always waiting SERVER_POST_TIMEOUT:
+# percentile of recent seconds per job size unit x job size x multiplier, clamped to [min, SERVER_POST_TIMEOUT].
+# Off by default - the job size ignores hires fix, img2img denoising and ControlNet units, so those jobs can time
+# out early after a run of plain txt2img jobs
+SD_WEBUI_ADAPTIVE_TIMEOUT = os.environ.get("SD_WEBUI_ADAPTIVE_TIMEOUT", "false").lower() == "true"
+SD_WEBUI_TIMEOUT_PERCENTILE = float(os.environ.get("SD_WEBUI_TIMEOUT_PERCENTILE", 99))
+SD_WEBUI_TIMEOUT_MULTIPLIER = float(os.environ.get("SD_WEBUI_TIMEOUT_MULTIPLIER", 3))
+SD_WEBUI_TIMEOUT_MIN_SECONDS = float(os.environ.get("SD_WEBUI_TIMEOUT_MIN_SECONDS", 60))
+SD_WEBUI_TIMEOUT_MIN_SAMPLES = int(os.environ.get("SD_WEBUI_TIMEOUT_MIN_SAMPLES", 20))
+SD_WEBUI_LATENCY_WINDOW = int(os.environ.get("SD_WEBUI_LATENCY_WINDOW", 200))
+
+# Stop taking messages from the queue while every SD WebUI backend is ejected, resume once one is re-admitted
+PAUSE_CONSUMING_WHEN_UNAVAILABLE = os.environ.get("PAUSE_CONSUMING_WHEN_UNAVAILABLE", "true").lower() == "true"
+
+###############WORKER###############
+# 'thread' spawns one thread per delivery (prefetch 1), 'pool' runs deliveries on a fixed set of
+# WORKER_CONCURRENCY slots and lets the broker prefetch exactly that many messages
+WORKER_EXECUTION_MODE = os.environ.get('WORKER_EXECUTION_MODE', 'thread').lower()
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 1))
+# Messages prefetched beyond WORKER_CONCURRENCY form the window the model-affinity scheduler reorders
+WORKER_PREFETCH_COUNT = int(os.environ.get('WORKER_PREFETCH_COUNT', WORKER_CONCURRENCY))
+WORKER_SCHEDULER = os.environ.get('WORKER_SCHEDULER', 'fifo').lower()  # 'fifo' | 'model_affinity'
+# Messages past their deadline (x-deadline / x-ttl-seconds headers or callback_message deadline / ttl_seconds)
+# get a failure callback without being processed. The default TTL applies to messages that only carry a
+# creation time, 0 = no default
+MESSAGE_DEFAULT_TTL_SECONDS = float(os.environ.get('MESSAGE_DEFAULT_TTL_SECONDS', 0))
+MESSAGE_DEADLINE_GRACE_SECONDS = float(os.environ.get('MESSAGE_DEADLINE_GRACE_SECONDS', 0))
+# Running jobs are checked for a cancellation flag in redis this often (0 = only between requests). A cancelled
+# job's generation is interrupted on SD WebUI when no other job shares the backend or its batch
+JOB_CANCELLATION_POLL_INTERVAL = float(os.environ.get('JOB_CANCELLATION_POLL_INTERVAL', 1))
+JOB_CANCELLATION_INTERRUPT = os.environ.get('JOB_CANCELLATION_INTERRUPT', 'true').lower() == 'true'
+# Prometheus metrics are served on this port at /metrics, 0 = disabled
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+METRICS_HOST = os.environ.get('METRICS_HOST', '0.0.0.0')
+
+# Spans per job and per redis/http/s3 call, exported by a background thread. 'none' | 'file' | 'otlp'.
+# The trace context is taken from the incoming message and passed on in the callback's traceparent header
+TRACING_EXPORTER = os.environ.get('TRACING_EXPORTER', 'none').lower()
+TRACING_FILE_PATH = os.environ.get('TRACING_FILE_PATH', 'tmp/traces.jsonl')
+TRACING_OTLP_ENDPOINT = os.environ.get('TRACING_OTLP_ENDPOINT', 'http://localhost:4318')
+TRACING_SERVICE_NAME = os.environ.get('TRACING_SERVICE_NAME', 'sd-webui-worker')
+# Records a sample of processed messages (secrets dropped, prompts masked) with their redis images and stage
+# timings to this directory, for replay with benchmarks/replay_corpus.py. Empty = disabled
+RECORD_CORPUS_DIR = os.environ.get('RECORD_CORPUS_DIR', '')
+RECORD_SAMPLE_RATE = float(os.environ.get('RECORD_SAMPLE_RATE', 0.01))
+RECORD_MAX_MESSAGES = int(os.environ.get('RECORD_MAX_MESSAGES', 1000))
+RECORD_REDACT_PROMPTS = os.environ.get('RECORD_REDACT_PROMPTS', 'true').lower() == 'true'
+# A queued job is run regardless of affinity once it waited this long or was overtaken this many times
+SCHEDULER_MAX_WAIT_SECONDS = float(os.environ.get('SCHEDULER_MAX_WAIT_SECONDS', 60))
+SCHEDULER_MAX_BYPASS = int(os.environ.get('SCHEDULER_MAX_BYPASS', 8))
+
 ###############AWS###############
 AWS_S3_BUCKET = os.environ.get("AWS_S3_BUCKET","pencil-production-bucket")
 R2_ENABLED = os.environ.get("R2_ENABLED", "true") == "true"
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 32))
+S3_MULTIPART_THRESHOLD = int(os.environ.get("S3_MULTIPART_THRESHOLD", 16 * 1024 * 1024))
+S3_MULTIPART_CONCURRENCY = int(os.environ.get("S3_MULTIPART_CONCURRENCY", 4))
 
 IMAGE_GENERATION_REDIS_EXPIRE = 3600
+# Threads used to decode/resize/encode the images of a job in parallel
+IMAGE_POSTPROCESS_WORKERS = int(os.environ.get("IMAGE_POSTPROCESS_WORKERS", min(4, os.cpu_count() or 1)))
+# In-process LRU cache for input images fetched from redis, 0 disables it
+INPUT_IMAGE_CACHE_MAX_BYTES = int(os.environ.get("INPUT_IMAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# 'raw' stores encoded image bytes (~25% smaller), 'base64' keeps the format other services read today.
+# Reads accept both.
+REDIS_IMAGE_STORAGE_FORMAT = os.environ.get("REDIS_IMAGE_STORAGE_FORMAT", "base64").lower()
 IMAGE_GENERATION_REDIS_LOCK_DURATION_SECONDS = 5
+IMAGE_GENERATION_TRACKING_KEY_EXPIRE = 7200
+# How result keys are appended to the ai_magic_tools_{job_id} tracking key:
+# 'atomic_json' - lock-free Lua append that keeps the JSON list format existing readers expect
+# 'list'        - native Redis list (RPUSH), converts a legacy JSON value on first append
+# 'redlock'     - legacy Redlock protected read-modify-write of the JSON list
+TRACKING_KEY_UPDATE_MODE = os.environ.get("TRACKING_KEY_UPDATE_MODE", "atomic_json").lower()
 
@@ -0,0 +1,269 @@
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urljoin
+
+import requests
+
+import src.config as config
+from src.common.circuit_breaker import CircuitBreaker, OPEN, CLOSED
+from src.common.logger import get_logger
+from src.sd_webui_proxy.model_state import get_checkpoint_key, get_options_state
+from src.sd_webui_proxy.util import check_server_readiness, get_session
+
+logger = get_logger(__name__)
+
+
+class NoHealthyBackendError(RuntimeError):
+    pass
+
+
+def is_backend_failure(e):
+    """Whether an exception says something about the backend rather than the job's payload"""
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and e.response.status_code >= 500
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+class Backend(object):
+    def __init__(self, url, breaker: CircuitBreaker):
+        self.url = url
+        self.options_state = get_options_state(url)
+        self.breaker = breaker
+        self.outstanding = 0
+        self.jobs = 0
+        self.interrupting = False
+
+    @property
+    def healthy(self):
+        return self.breaker.is_closed
+
+    def checkpoint_key(self):
+        return get_checkpoint_key({'sd_model_checkpoint': self.options_state.current_checkpoint()})
+
+
+class BackendPool(object):
+    """Routes jobs across several SD WebUI servers.
+
+    Each job leases one backend for its whole run, so its options switch, chained requests and
+    upscale all land on the same server. A backend is picked among the healthy ones by least
+    outstanding jobs, preferring one that already has the job's checkpoint loaded unless it is
+    more than affinity_slack jobs busier.
+
+    Every backend has a CircuitBreaker: it is ejected (opened) after eject_after_failures
+    consecutive failed jobs or health checks, and re-admitted (closed) after
+    readmit_after_successes consecutive successful health checks against /sdapi/v1/progress.
+    With health checks disabled (health_check_interval 0) nothing is ever ejected, since nothing
+    could re-admit it. Availability listeners are told when the last backend is ejected and when
+    one is back.
+    """
+
+    def __init__(self, api_endpoints, health_check_interval=10, eject_after_failures=3,
+                 readmit_after_successes=2, affinity_slack=1):
+        if not api_endpoints:
+            raise ValueError("At least one SD WebUI endpoint is needed - check SD_WEBUI_API_ENDPOINTS")
+        self._backends = [
+            Backend(url, CircuitBreaker(name=url,
+                                        failure_threshold=eject_after_failures,
+                                        success_threshold=readmit_after_successes,
+                                        on_state_change=self._on_breaker_state_change))
+            for url in api_endpoints
+        ]
+        self._health_check_interval = health_check_interval
+        self._affinity_slack = affinity_slack
+        self._lock = threading.Lock()
+        self._interrupt_done = threading.Condition(self._lock)
+        self._availability_lock = threading.Lock()
+        self._availability_listeners = []
+        self._available = True
+        self._session = get_session(0, 0)
+        self._stop_event = threading.Event()
+        self._health_check_thread = None
+
+    @property
+    def backends(self):
+        return list(self._backends)
+
+    def check_readiness(self, init_sleep_seconds=0):
+        """Checks every backend at startup, ejecting the ones that aren't up. Raises if none are"""
+        if init_sleep_seconds > 0:
+            time.sleep(init_sleep_seconds)
+
+        error = None
+        ready = 0
+        for backend in self._backends:
+            try:
+                check_server_readiness(api_endpoint=backend.url)
+            except Exception as e:
+                logger.warning(f"SD WebUI backend {backend.url} is not ready: {e}")
+                error = e
+                if self._health_check_interval > 0:
+                    backend.breaker.open()
+                continue
+
+            ready += 1
+            try:
+                backend.options_state.refresh()
+            except Exception as e:
+                # Not fatal - the options will be read again before the first switch
+                logger.warning(f"Couldn't read SD WebUI options of {backend.url}: {e}")
+
+        if ready == 0:
+            raise error
+
+    def start(self):
+        if self._health_check_interval > 0:
+            self._health_check_thread = threading.Thread(
+                target=self._run_health_checks, name='sd-webui-health-check', daemon=True)
+            self._health_check_thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run_health_checks(self):
+        while not self._stop_event.wait(self._health_check_interval):
+            for backend in self._backends:
+                self.check_health(backend)
+
+    def check_health(self, backend):
+        try:
+            res = self._session.get(url=urljoin(backend.url, config.SD_WEBUI_PROGRESS_ENDPOINT),
+                                    timeout=config.SERVER_CHECK_TIMEOUT)
+            res.raise_for_status()
+        except Exception as e:
+            logger.warning(f"Health check of SD WebUI backend {backend.url} failed: {e}")
+            self.report_failure(backend)
+            return False
+
+        backend.breaker.record_probe(True)
+        return True
+
+    def report_success(self, backend):
+        backend.breaker.record_success()
+
+    def report_failure(self, backend):
+        if self._health_check_interval > 0:
+            backend.breaker.record_failure()
+
+    def add_availability_listener(self, listener):
+        """listener(available) is called when no backend is left to take jobs and when one is back"""
+        self._availability_listeners.append(listener)
+
+    def _on_breaker_state_change(self, breaker, old_state, new_state):
+        backend = next(backend for backend in self._backends if backend.breaker is breaker)
+        if new_state == OPEN:
+            # It may come back restarted with other options loaded
+            backend.options_state.invalidate()
+            logger.warning(f"Ejected SD WebUI backend {backend.url}")
+        elif new_state == CLOSED:
+            logger.info(f"Re-admitted SD WebUI backend {backend.url}")
+
+        # Held while notifying so listeners see pause/resume in the order the transitions happened
+        with self._availability_lock:
+            available = any(backend.healthy for backend in self._backends)
+            if available == self._available:
+                return
+            self._available = available
+
+            logger.warning(f"SD WebUI backends available: {available}")
+            for listener in self._availability_listeners:
+                try:
+                    listener(available)
+                except Exception as e:
+                    logger.error(f"Backend availability listener failed: {e}", exc_info=True)
+
+    def _select(self, checkpoint_key):
+        healthy = [backend for backend in self._backends if backend.healthy]
+        if not healthy:
+            raise NoHealthyBackendError("No healthy SD WebUI backend available")
+
+        # Backends being interrupted only if there is nothing else, and then lease waits for the interrupt
+        healthy = [backend for backend in healthy if not backend.interrupting] or healthy
+        least_busy = min(healthy, key=lambda backend: (backend.outstanding, backend.jobs))
+        if checkpoint_key is None:
+            return least_busy
+
+        loaded = [backend for backend in healthy if backend.checkpoint_key() == checkpoint_key]
+        if loaded:
+            best_loaded = min(loaded, key=lambda backend: (backend.outstanding, backend.jobs))
+            if best_loaded.outstanding <= least_busy.outstanding + self._affinity_slack:
+                return best_loaded
+
+        return least_busy
+
+    @contextmanager
+    def lease(self, options_payload=None):
+        """Picks a backend for the job, applies options_payload on it and yields it for the duration of the block"""
+        with self._lock:
+            backend = self._select(get_checkpoint_key(options_payload))
+            while backend.interrupting:
+                # Every healthy backend is being interrupted - an interrupt must not hit this job's generation
+                self._interrupt_done.wait()
+                backend = self._select(get_checkpoint_key(options_payload))
+            backend.outstanding += 1
+            backend.jobs += 1
+
+        try:
+            with backend.options_state.lease(options_payload):
+                yield backend
+        except Exception as e:
+            if is_backend_failure(e):
+                self.report_failure(backend)
+            raise
+        else:
+            self.report_success(backend)
+        finally:
+            with self._lock:
+                backend.outstanding -= 1
+
+    def try_claim_interrupt(self, backend):
+        """
+        Whether the job alone on backend may interrupt its generation. Until release_interrupt no other job
+        is leased onto the backend, so SD WebUI's /interrupt can't stop another job's generation
+        """
+        with self._lock:
+            if backend.outstanding != 1 or backend.interrupting:
+                return False
+            backend.interrupting = True
+            return True
+
+    def release_interrupt(self, backend):
+        with self._lock:
+            backend.interrupting = False
+            self._interrupt_done.notify_all()
+
+    def loaded_checkpoint_keys(self):
+        return [backend.checkpoint_key() for backend in self._backends if backend.healthy]
+
+    def stats(self):
+        with self._lock:
+            return {
+                backend.url: {
+                    'healthy': backend.healthy,
+                    'outstanding': backend.outstanding,
+                    'jobs': backend.jobs,
+                    'breaker': backend.breaker.stats(),
+                    'checkpoint': backend.options_state.current_checkpoint(),
+                }
+                for backend in self._backends
+            }
+
+
+_backend_pool = None
+_backend_pool_lock = threading.Lock()
+
+
+def get_backend_pool():
+    global _backend_pool
+
+    with _backend_pool_lock:
+        if _backend_pool is None:
+            _backend_pool = BackendPool(
+                api_endpoints=config.SD_WEBUI_API_ENDPOINTS,
+                health_check_interval=config.SD_WEBUI_HEALTH_CHECK_INTERVAL,
+                eject_after_failures=config.SD_WEBUI_EJECT_AFTER_FAILURES,
+                readmit_after_successes=config.SD_WEBUI_READMIT_AFTER_SUCCESSES,
+                affinity_slack=config.SD_WEBUI_CHECKPOINT_AFFINITY_SLACK,
+            )
+
+    return _backend_pool
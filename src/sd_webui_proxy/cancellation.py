@@ -0,0 +1,188 @@
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urljoin
+
+import src.config as config
+from src.common.logger import get_logger
+from src.sd_webui_proxy.util import get_cancelled_job_ids, get_session
+
+logger = get_logger(__name__)
+
+
+class JobCancelledError(RuntimeError):
+    pass
+
+
+class CancellationToken(object):
+    """Cancellation state of one running job.
+
+    The processor sets backend and backend_pool once it leased one, and get_generated_images wraps every SD WebUI
+    generation call in request(). check() raises JobCancelledError once the job is cancelled, and
+    request() checks again when the call returns, since an interrupted generation still comes back
+    as a normal (partial) response.
+    """
+
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        self.backend = None
+        self.backend_pool = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._in_request = False
+        self._coalesced = False
+        self._interrupted = False
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+
+    def check(self, refresh=False):
+        """Raises JobCancelledError if the job is cancelled, with refresh asking redis first"""
+        if refresh and self.job_id is not None and not self.cancelled:
+            if get_cancelled_job_ids([self.job_id]):
+                self.cancel()
+
+        if self.cancelled:
+            raise JobCancelledError(f"Job {self.job_id} was cancelled")
+
+    @contextmanager
+    def request(self, coalesced=False):
+        with self._lock:
+            self._in_request = True
+            self._coalesced = coalesced
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_request = False
+                self._coalesced = False
+        self.check()
+
+    def claim_interrupt(self):
+        """
+        Whether the backend can be interrupted for this job: a generation of it is running, it isn't
+        merged with other jobs' requests and the backend pool claims the backend for it, which it only
+        does while no other job is on it. True only once per job, followed by release_interrupt
+        """
+        with self._lock:
+            if (self._interrupted or not self._in_request or self._coalesced
+                    or self.backend is None or self.backend_pool is None
+                    or not self.backend_pool.try_claim_interrupt(self.backend)):
+                return False
+            self._interrupted = True
+            return True
+
+    def release_interrupt(self):
+        self.backend_pool.release_interrupt(self.backend)
+
+
+class CancellationWatcher(object):
+    """Polls redis for cancellation flags of the running jobs and interrupts their generation.
+
+    SD WebUI's /sdapi/v1/interrupt stops whatever the server is generating, so it is only called when
+    the cancelled job is alone on its backend and not part of a coalesced batch. Otherwise the job
+    stops after its current request.
+    """
+
+    def __init__(self, poll_interval=1.0, interrupt=True):
+        self._poll_interval = poll_interval
+        self._interrupt = interrupt
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._thread = None
+        self._session = get_session(0, 0)
+        self._cancelled = 0
+        self._interrupted = 0
+
+    def _ensure_started(self):
+        if self._poll_interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='job-cancellation-watcher', daemon=True)
+        self._thread.start()
+
+    @contextmanager
+    def watch(self, job_id):
+        """Registers a running job and yields its CancellationToken. Raises if it is already cancelled"""
+        token = CancellationToken(job_id)
+        if job_id is None:
+            yield token
+            return
+
+        try:
+            token.check(refresh=True)
+        except JobCancelledError:
+            with self._lock:
+                self._cancelled += 1
+            raise
+
+        with self._lock:
+            self._tokens.setdefault(job_id, []).append(token)
+            self._ensure_started()
+        try:
+            yield token
+        finally:
+            with self._lock:
+                tokens = self._tokens.get(job_id, [])
+                if token in tokens:
+                    tokens.remove(token)
+                if not tokens:
+                    self._tokens.pop(job_id, None)
+                if token.cancelled:
+                    self._cancelled += 1
+
+    def _run(self):
+        while True:
+            time.sleep(self._poll_interval)
+            with self._lock:
+                job_ids = list(self._tokens.keys())
+            if not job_ids:
+                continue
+
+            try:
+                cancelled_job_ids = get_cancelled_job_ids(job_ids)
+            except Exception as e:
+                logger.warning(f"Couldn't check job cancellations: {e}")
+                continue
+
+            for job_id in cancelled_job_ids:
+                with self._lock:
+                    tokens = list(self._tokens.get(job_id, []))
+                for token in tokens:
+                    if not token.cancelled:
+                        logger.info(f"Job {job_id} was cancelled")
+                        token.cancel()
+                    self._interrupt_generation(token)
+
+    def _interrupt_generation(self, token):
+        if not self._interrupt or not token.claim_interrupt():
+            return
+
+        url = urljoin(token.backend.url, config.SD_WEBUI_INTERRUPT_ENDPOINT)
+        try:
+            res = self._session.post(url=url, timeout=config.SERVER_CHECK_TIMEOUT)
+            res.raise_for_status()
+            with self._lock:
+                self._interrupted += 1
+            logger.info(f"Interrupted generation of cancelled job {token.job_id} on {token.backend.url}")
+        except Exception as e:
+            logger.warning(f"Couldn't interrupt generation of cancelled job {token.job_id}: {e}")
+        finally:
+            token.release_interrupt()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'active': sum(len(tokens) for tokens in self._tokens.values()),
+                'cancelled': self._cancelled,
+                'interrupted': self._interrupted,
+            }
+
+
+cancellation_watcher = CancellationWatcher(
+    poll_interval=config.JOB_CANCELLATION_POLL_INTERVAL,
+    interrupt=config.JOB_CANCELLATION_INTERRUPT,
+)
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import threading
+
+import src.config as config
+from src.common.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Payload fields that may differ between coalesced requests - everything else must match exactly
+BATCH_FIELDS = ("batch_size", "n_iter", "seed", "resize_payload")
+# Strings at least this long - base64 images by the time a request is coalesced - are keyed by a digest
+DIGEST_MIN_LENGTH = 1024
+
+
+def get_key_value(value):
+    """
+    value with long strings replaced by their 128-bit blake2b digest, which takes a fraction of the time of
+    serializing and hashing the base64 data as part of the whole payload
+    """
+    if isinstance(value, str):
+        if len(value) < DIGEST_MIN_LENGTH:
+            return value
+        return f"<blake2b:{hashlib.blake2b(value.encode('utf-8'), digest_size=16).hexdigest()}>"
+    if isinstance(value, dict):
+        return {k: get_key_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [get_key_value(v) for v in value]
+    return value
+
+
+class _Batch(object):
+    def __init__(self, payload):
+        self.payload = payload
+        self.batch_sizes = []
+        self.total = 0
+        self.results = []
+        self.error = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+    def add(self, batch_size):
+        self.batch_sizes.append(batch_size)
+        self.total += batch_size
+        return len(self.batch_sizes) - 1
+
+
+class RequestCoalescer(object):
+    """Merges identical generation requests from concurrent jobs into one SD WebUI call.
+
+    The first request for a key becomes the leader and waits up to window_seconds for other
+    jobs to join (or until max_batch_size images are requested). It then posts a single payload
+    with the summed batch_size and splits images and seeds back to each member in join order.
+    Requests are only eligible when their seed is random (-1) and n_iter is 1, since SD WebUI
+    derives the seeds of a batch from a single starting seed.
+    """
+
+    def __init__(self, window_seconds, max_batch_size):
+        self._window_seconds = window_seconds
+        self._max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._open_batches = {}
+        self._batches = 0
+        self._coalesced_requests = 0
+
+    @property
+    def enabled(self):
+        return self._window_seconds > 0 and self._max_batch_size > 1
+
+    def is_coalescable(self, endpoint, payload):
+        return (
+            self.enabled
+            and endpoint.strip("/") in config.SD_WEBUI_COALESCE_ENDPOINTS
+            and payload.get("seed", -1) in (-1, None)
+            and (payload.get("n_iter", 1) or 1) == 1
+            and (payload.get("batch_size", 1) or 1) < self._max_batch_size
+        )
+
+    @staticmethod
+    def get_key(endpoint, payload, sd_webui_options_payload=None):
+        key_payload = {k: get_key_value(v) for k, v in payload.items() if k not in BATCH_FIELDS}
+        serialized = json.dumps([endpoint, get_key_value(sd_webui_options_payload), key_payload],
+                                sort_keys=True, default=str)
+        return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+    def submit(self, key, payload, batch_size, execute):
+        """
+        Runs execute(payload) -> (images, seeds) either directly or as part of a merged batch
+        and returns this request's share of the images and seeds
+        """
+        with self._lock:
+            batch = self._open_batches.get(key)
+            if batch is not None and batch.total + batch_size <= self._max_batch_size:
+                is_leader = False
+                index = batch.add(batch_size)
+                if batch.total >= self._max_batch_size:
+                    del self._open_batches[key]
+                    batch.full.set()
+            else:
+                is_leader = True
+                batch = _Batch(payload)
+                index = batch.add(batch_size)
+                self._open_batches[key] = batch
+
+        if is_leader:
+            batch.full.wait(self._window_seconds)
+            with self._lock:
+                if self._open_batches.get(key) is batch:
+                    del self._open_batches[key]
+                self._batches += 1
+                self._coalesced_requests += len(batch.batch_sizes) - 1
+            self._run(batch, execute)
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+
+        return batch.results[index]
+
+    @staticmethod
+    def _run(batch, execute):
+        try:
+            merged_payload = dict(batch.payload)
+            merged_payload["batch_size"] = batch.total
+
+            if len(batch.batch_sizes) > 1:
+                logger.info(f"Coalesced {len(batch.batch_sizes)} requests into one batch of {batch.total} images")
+
+            images, seeds = execute(merged_payload)
+            images = images or []
+            seeds = seeds or []
+
+            offset = 0
+            for batch_size in batch.batch_sizes:
+                batch.results.append((images[offset:offset + batch_size], seeds[offset:offset + batch_size]))
+                offset += batch_size
+
+        except Exception as e:
+            batch.error = e
+
+        finally:
+            batch.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'batches': self._batches,
+                'coalesced_requests': self._coalesced_requests,
+            }
+
+
+coalescer = RequestCoalescer(
+    window_seconds=config.SD_WEBUI_COALESCE_WINDOW_MS / 1000.0,
+    max_batch_size=config.SD_WEBUI_COALESCE_MAX_BATCH_SIZE,
+)
@@ -2,4 +2,6 @@
 
 GENERATED_IMAGES_S3_BASE_PATH = "generated_images"
 
-AI_MAGIC_TOOLS_REDIS_KEY_PREFIX = 'ai_magic_tools'
\ No newline at end of file
+AI_MAGIC_TOOLS_REDIS_KEY_PREFIX = 'ai_magic_tools'
+
+JOB_CANCELLATION_REDIS_KEY_PREFIX = 'sd_webui_cancel'
@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import OrderedDict
+
+import src.config as config
+from src.common.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class ImageCache(object):
+    """Thread-safe LRU cache of image values fetched from Redis, keyed by their s3 url.
+
+    The total size of cached values is kept under max_bytes by evicting the least recently used
+    entries, and entries expire ttl_seconds after they were added. Redis image keys are unique
+    uuids that are never rewritten, so a cached value can't go stale before it expires.
+    """
+
+    def __init__(self, max_bytes, ttl_seconds):
+        self._max_bytes = max_bytes
+        self._ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @property
+    def enabled(self):
+        return self._max_bytes > 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return value
+                self._remove(key)
+
+            self._misses += 1
+            return None
+
+    def put(self, key, value):
+        size = len(value)
+        if size > self._max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.monotonic() + self._ttl_seconds, value)
+            self._bytes += size
+
+            while self._bytes > self._max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self._evictions += 1
+
+    def _remove(self, key):
+        _, value = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self._max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_rate': self._hits / lookups if lookups else 0.0,
+            }
+
+
+input_image_cache = ImageCache(
+    max_bytes=config.INPUT_IMAGE_CACHE_MAX_BYTES,
+    ttl_seconds=config.IMAGE_GENERATION_REDIS_EXPIRE,
+)
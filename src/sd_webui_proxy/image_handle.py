@@ -0,0 +1,134 @@
+import base64
+import io
+
+from PIL import Image
+
+# Signatures of the encoded formats SD WebUI and our callers produce
+IMAGE_SIGNATURES = (
+    b"\xff\xd8\xff",  # JPEG
+    b"\x89PNG\r\n\x1a\n",  # PNG
+    b"RIFF",  # WEBP
+    b"GIF8",  # GIF
+)
+
+# Downscales by at least this factor first shrink cheaply (JPEG draft / Image.reduce) before LANCZOS
+RESIZE_REDUCING_GAP = 2.0
+
+
+def is_encoded_image(data: bytes) -> bool:
+    return data.startswith(IMAGE_SIGNATURES)
+
+
+class ImageHandle(object):
+    """An encoded image (JPEG/PNG bytes) passed through the pipeline.
+
+    The raw bytes, their base64 form and the decoded PIL image are each produced lazily and
+    cached, so a handle created from an SD WebUI response can be handed to the next request
+    without decoding it, and a handle read from Redis as raw bytes is only base64 encoded when it
+    is actually sent to SD WebUI.
+
+    resized() is lazy as well: it records the target size and the original source, and the
+    image is only decoded, resized and encoded when its data is first needed. Resizing a
+    pending resize again replaces the target, so consecutive resize steps cost one decode and
+    one encode.
+    """
+
+    def __init__(self, data: bytes = None, base64_data: str = None, image: Image.Image = None,
+                 source=None, target_size=None, format="JPEG"):
+        assert data is not None or base64_data is not None or source is not None, \
+            "ImageHandle needs data, base64_data or a resize source"
+        self._data = data
+        self._base64_data = base64_data
+        self._image = image
+        self._source = source
+        self._target_size = target_size
+        self._format = format
+
+    @classmethod
+    def from_base64(cls, base64_data):
+        if isinstance(base64_data, bytes):
+            base64_data = base64_data.decode('utf-8')
+        return cls(base64_data=base64_data)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        return cls(data=data)
+
+    @classmethod
+    def from_image(cls, image: Image.Image, format="JPEG"):
+        image_binary = io.BytesIO()
+        image.save(image_binary, format=format)
+        return cls(data=image_binary.getvalue(), image=image)
+
+    @classmethod
+    def from_redis_value(cls, value: bytes):
+        """Accepts both raw encoded bytes and legacy base64 text stored in Redis"""
+        if is_encoded_image(value):
+            return cls.from_bytes(value)
+        return cls.from_base64(value)
+
+    @property
+    def is_materialized(self):
+        return self._data is not None or self._base64_data is not None
+
+    def materialize(self):
+        """Runs a pending resize and encodes the result"""
+        if not self.is_materialized:
+            image = self._source._open_for_resize(self._target_size)
+            image = image.resize(self._target_size, Image.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+
+            image_binary = io.BytesIO()
+            image.save(image_binary, format=self._format)
+            self._data = image_binary.getvalue()
+            self._image = image
+            self._source = None
+        return self
+
+    def _open_for_resize(self, target_size):
+        if self._image is not None:
+            return self._image
+
+        # A fresh, not yet loaded image so JPEG draft mode can decode straight at a reduced scale
+        image = Image.open(io.BytesIO(self.data))
+        if image.format == "JPEG":
+            width, height = target_size
+            image.draft(image.mode, (int(width * RESIZE_REDUCING_GAP), int(height * RESIZE_REDUCING_GAP)))
+        return image
+
+    @property
+    def data(self) -> bytes:
+        if self._data is None:
+            if self._base64_data is None:
+                self.materialize()
+            else:
+                self._data = base64.b64decode(self._base64_data)
+        return self._data
+
+    @property
+    def image(self) -> Image.Image:
+        if self._image is None:
+            self._image = Image.open(io.BytesIO(self.data))
+        return self._image
+
+    @property
+    def size(self):
+        if self._target_size is not None:
+            return self._target_size
+        # Image.open only parses the header, pixels are decoded on first access
+        return self.image.size
+
+    def to_base64(self) -> str:
+        if self._base64_data is None:
+            self._base64_data = base64.b64encode(self.data).decode('utf-8')
+        return self._base64_data
+
+    def resized(self, width, height, format="JPEG"):
+        source = self if self.is_materialized or self._source is None else self._source
+        return ImageHandle(source=source, target_size=(width, height), format=format)
+
+    def __repr__(self):
+        if self._data is not None:
+            return f"ImageHandle({len(self._data)} bytes)"
+        if self._target_size is not None and not self.is_materialized:
+            return f"ImageHandle(pending resize to {self._target_size})"
+        return "ImageHandle(base64)"
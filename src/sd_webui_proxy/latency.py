@@ -0,0 +1,92 @@
+import math
+import threading
+from collections import deque
+
+import src.config as config
+
+
+class AdaptiveTimeoutError(RuntimeError):
+    """
+    A request took longer than its adaptive timeout. Not a requests exception on purpose, so it doesn't count
+    as a backend failure - the estimate may just be off for this payload
+    """
+    pass
+
+
+def get_job_size(payload):
+    """
+    Rough amount of work an SD WebUI request asks for, in units of one 512x512 image at 20 steps
+    """
+    if not isinstance(payload, dict):
+        return 1.0
+
+    images = len(payload.get("imageList") or []) or (payload.get("batch_size") or 1) * (payload.get("n_iter") or 1)
+    pixels = (payload.get("width") or 512) * (payload.get("height") or 512) / (512 * 512)
+    steps = (payload.get("steps") or 20) / 20
+    upscale = (payload.get("upscaling_resize") or 1) ** 2
+
+    return max(images * pixels * steps * upscale, 1.0)
+
+
+class LatencyTracker(object):
+    """Recent request latencies per endpoint, normalised by job size, used to derive timeouts.
+
+    The timeout for a request is the given percentile of recent seconds-per-unit on its endpoint,
+    times the request's job size, times multiplier, clamped to [min_timeout, max_timeout]. Until
+    an endpoint has min_samples observations max_timeout is used.
+    """
+
+    def __init__(self, window_size=200, percentile=99, multiplier=3.0, min_samples=20,
+                 min_timeout=60, max_timeout=600):
+        self._window_size = window_size
+        self._percentile = percentile
+        self._multiplier = multiplier
+        self._min_samples = min_samples
+        self._min_timeout = min_timeout
+        self._max_timeout = max_timeout
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def record(self, key, seconds, job_size=1.0):
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = deque(maxlen=self._window_size)
+                self._samples[key] = samples
+            samples.append(seconds / job_size)
+
+    def _get_percentile(self, samples, percentile):
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(percentile / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    def get_timeout(self, key, job_size=1.0):
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None or len(samples) < self._min_samples:
+                return self._max_timeout
+            seconds_per_unit = self._get_percentile(samples, self._percentile)
+
+        timeout = seconds_per_unit * job_size * self._multiplier
+        return min(self._max_timeout, max(self._min_timeout, timeout))
+
+    def stats(self):
+        with self._lock:
+            return {
+                key: {
+                    'samples': len(samples),
+                    'p50': self._get_percentile(samples, 50),
+                    f'p{self._percentile}': self._get_percentile(samples, self._percentile),
+                }
+                for key, samples in self._samples.items() if samples
+            }
+
+
+latency_tracker = LatencyTracker(
+    window_size=config.SD_WEBUI_LATENCY_WINDOW,
+    percentile=config.SD_WEBUI_TIMEOUT_PERCENTILE,
+    multiplier=config.SD_WEBUI_TIMEOUT_MULTIPLIER,
+    min_samples=config.SD_WEBUI_TIMEOUT_MIN_SAMPLES,
+    min_timeout=config.SD_WEBUI_TIMEOUT_MIN_SECONDS,
+    max_timeout=config.SERVER_POST_TIMEOUT,
+)
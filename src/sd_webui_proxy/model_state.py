@@ -0,0 +1,213 @@
+import os
+import re
+import threading
+from contextlib import contextmanager
+from urllib.parse import urljoin
+
+import src.config as config
+from src.common.logger import get_logger
+from src.common.metrics import time_stage
+from src.common.tracing import traced
+from src.sd_webui_proxy.sdwebui_post_callback_util import post_request
+from src.sd_webui_proxy.util import get_session
+
+logger = get_logger(__name__)
+
+# Options whose values SD WebUI reports back as titles e.g. "sd_xl_base_1.0.safetensors [31e35c80fc]"
+MODEL_OPTION_KEYS = ("sd_model_checkpoint", "sd_vae")
+_MODEL_HASH_SUFFIX = re.compile(r"\s*\[[0-9a-fA-F]+\]$")
+
+
+def _normalise_model_name(value):
+    name = _MODEL_HASH_SUFFIX.sub("", value.strip())
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+def get_checkpoint_key(options_payload):
+    """Normalised checkpoint name an options payload asks for, or None if it doesn't switch checkpoints"""
+    checkpoint = (options_payload or {}).get("sd_model_checkpoint")
+    if not isinstance(checkpoint, str) or not checkpoint:
+        return None
+    return _normalise_model_name(checkpoint)
+
+
+def option_value_matches(key, applied_value, requested_value):
+    if applied_value == requested_value:
+        return True
+
+    if key in MODEL_OPTION_KEYS and isinstance(applied_value, str) and isinstance(requested_value, str):
+        return _normalise_model_name(applied_value) == _normalise_model_name(requested_value)
+
+    return False
+
+
+class SDWebUIOptionsState(object):
+    """Tracks the options currently applied on one SD WebUI backend.
+
+    Jobs take a lease() for the options they need. Only the keys that differ from what is
+    applied are POSTed, and the call is skipped entirely when nothing changes. While any lease is
+    held the options cannot be switched by another job, so concurrent jobs never have the model
+    swapped underneath them. Jobs needing a switch wait until the running ones are done, and new
+    compatible jobs queue behind them so a switch can't starve. The applied state is verified
+    via GET at startup and again after any error.
+    """
+
+    def __init__(self, api_endpoint):
+        self._api_endpoint = api_endpoint
+        self._condition = threading.Condition()
+        self._session = get_session(config.SERVER_CHECK_RETRIES, config.SERVER_CHECK_BACKOFF)
+        self._applied = None
+        self._switching = False
+        self._in_flight = 0
+        self._waiting = 0
+        self._hits = 0
+        self._misses = 0
+        self._refreshes = 0
+
+    @property
+    def api_endpoint(self):
+        return self._api_endpoint
+
+    @traced("http.get_options")
+    def _fetch_options(self):
+        res = self._session.get(url=urljoin(self._api_endpoint, config.SET_SD_WEBUI_OPTIONS_ENDPOINT),
+                                timeout=config.SERVER_CHECK_TIMEOUT)
+        res.raise_for_status()
+        return res.json()
+
+    def refresh(self):
+        applied = self._fetch_options()
+        with self._condition:
+            self._applied = applied
+            self._refreshes += 1
+            self._condition.notify_all()
+        logger.info(f"Refreshed SD WebUI options - checkpoint: {applied.get('sd_model_checkpoint')}")
+
+    def invalidate(self):
+        with self._condition:
+            self._applied = None
+
+    def current_checkpoint(self):
+        with self._condition:
+            if self._applied is None:
+                return None
+            return self._applied.get("sd_model_checkpoint")
+
+    def get_diff(self, options_payload):
+        with self._condition:
+            return self._get_diff(options_payload)
+
+    def _get_diff(self, options_payload):
+        if not options_payload:
+            return {}
+        if self._applied is None:
+            return dict(options_payload)
+
+        return {
+            key: value for key, value in options_payload.items()
+            if key not in self._applied or not option_value_matches(key, self._applied[key], value)
+        }
+
+    def _acquire(self, options_payload):
+        """Blocks until the job can run with options_payload and returns True if it has to switch"""
+        waiting = False
+        try:
+            with self._condition:
+                while True:
+                    if not self._switching:
+                        diff = self._get_diff(options_payload)
+
+                        if not diff and (waiting or self._waiting == 0):
+                            self._in_flight += 1
+                            if options_payload:
+                                self._hits += 1
+                            return False
+
+                        if diff and self._in_flight == 0:
+                            self._in_flight += 1
+                            self._switching = True
+                            return True
+
+                    if not waiting:
+                        waiting = True
+                        self._waiting += 1
+                    self._condition.wait()
+        finally:
+            if waiting:
+                with self._condition:
+                    self._waiting -= 1
+
+    def _switch(self, options_payload):
+        try:
+            if self._applied is None:
+                self.refresh()
+
+            diff = self.get_diff(options_payload)
+            if diff:
+                logger.info(f"Switching SD WebUI options: {list(diff.keys())}")
+                with time_stage("options_switch", config.SET_SD_WEBUI_OPTIONS_ENDPOINT.strip("/")):
+                    post_request(url=urljoin(self._api_endpoint, config.SET_SD_WEBUI_OPTIONS_ENDPOINT), payload=diff)
+                logger.info("Completed switching models")
+
+            with self._condition:
+                if diff:
+                    self._misses += 1
+                    self._applied.update(diff)
+                else:
+                    self._hits += 1
+                self._switching = False
+                self._condition.notify_all()
+
+        except Exception:
+            with self._condition:
+                self._applied = None
+                self._switching = False
+            self._release()
+            raise
+
+    def _release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def lease(self, options_payload=None):
+        """Applies options_payload if needed and holds it for the duration of the block"""
+        if self._acquire(options_payload):
+            self._switch(options_payload)
+
+        try:
+            yield
+        except Exception:
+            # We don't know what state the backend was left in - re-read it on the next switch
+            self.invalidate()
+            raise
+        finally:
+            self._release()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'refreshes': self._refreshes,
+                'in_flight': self._in_flight,
+                'waiting': self._waiting,
+                'checkpoint': None if self._applied is None else self._applied.get("sd_model_checkpoint"),
+            }
+
+
+_options_states = {}
+_options_states_lock = threading.Lock()
+
+
+def get_options_state(api_endpoint=None):
+    api_endpoint = api_endpoint or config.SD_WEBUI_API_ENDPOINT
+
+    with _options_states_lock:
+        options_state = _options_states.get(api_endpoint)
+        if options_state is None:
+            options_state = SDWebUIOptionsState(api_endpoint)
+            _options_states[api_endpoint] = options_state
+
+    return options_state
@@ -0,0 +1,68 @@
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import src.config as config
+from src.sd_webui_proxy.image_handle import ImageHandle
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_postprocess_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.IMAGE_POSTPROCESS_WORKERS,
+                                           thread_name_prefix='image-postprocess')
+    return _executor
+
+
+def map_images(fn: Callable, images: List[ImageHandle]) -> List:
+    """
+    Applies fn to every image, fanning out over the post-processing thread pool.
+    Pillow releases the GIL while decoding, resizing and encoding so this scales with cores
+    """
+    if len(images) <= 1 or config.IMAGE_POSTPROCESS_WORKERS <= 1:
+        return [fn(image) for image in images]
+    return list(get_postprocess_executor().map(fn, images))
+
+
+def materialize_images(images: List[ImageHandle]) -> List[ImageHandle]:
+    """
+    Runs all pending resizes in parallel
+    """
+    return map_images(lambda image: image.materialize(), images)
+
+
+def resize_images(images: List[ImageHandle], resize_width: int, resize_height: int) -> List[ImageHandle]:
+    """
+    Returns lazily resized handles - the work happens once their data is needed or on materialize_images
+    """
+    return [image.resized(resize_width, resize_height) for image in images]
+
+
+def downscale_to_cover(image: ImageHandle, width: int, height: int, min_ratio: float = 1.0) -> ImageHandle:
+    """
+    Shrinks image (keeping its aspect ratio and format) to the smallest size that still covers width x height,
+    so SD WebUI's own resize/crop of the input gives the same result. Returns image unchanged if it isn't
+    at least min_ratio times larger than needed
+    """
+    image_width, image_height = image.size
+    scale = max(width / image_width, height / image_height)
+    if scale * min_ratio > 1:
+        return image
+
+    # Masks and other PNG inputs stay lossless
+    image_format = image.image.format or "PNG"
+    return image.resized(math.ceil(image_width * scale), math.ceil(image_height * scale), format=image_format)
+
+
+def downscale_input_images(images: Dict[str, ImageHandle], width: int, height: int,
+                           min_ratio: float = 1.0) -> Dict[str, ImageHandle]:
+    keys = list(images.keys())
+    downscaled = map_images(lambda image: downscale_to_cover(image, width, height, min_ratio).materialize(),
+                            [images[key] for key in keys])
+    return dict(zip(keys, downscaled))
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import src.config as config
+from src.common.logger import get_logger
+from src.common.metrics import collect_stage_timings
+from src.common.utils import redact_params
+from src.sd_webui_proxy.util import get_by_redis_keys
+
+logger = get_logger(__name__)
+
+MESSAGES_FILE = 'messages.jsonl'
+IMAGES_DIR = 'images'
+PROMPT_KEYS = ('prompt', 'negative_prompt')
+
+
+def get_image_keys(params):
+    """
+    Redis keys of the input images a message refers to - the fields replace_image_s3_url_to_base64 and
+    get_upscaled_images read
+    """
+    keys = []
+    for chain in params.get("requests") or []:
+        for request in chain or []:
+            payload = (request or {}).get("payload") or {}
+            keys.extend(payload.get("init_images") or [])
+            keys.extend([payload.get("input_image"), payload.get("mask")])
+            controlnet = ((payload.get("alwayson_scripts") or {}).get("controlnet") or {}).get("args") or []
+            keys.extend(cfg.get("image") for cfg in controlnet)
+
+    keys.extend((params.get("upscale_payload") or {}).get("imageList") or [])
+    return list(dict.fromkeys(key for key in keys if isinstance(key, str) and key))
+
+
+class MessageRecorder(object):
+    """Records a sample of processed messages into a corpus directory for replay:
+
+    messages.jsonl   one line per message - its redacted params, the digests of the redis images it
+                     refers to by key, when it was processed and the stage timings of processing it
+    images/<digest>  raw redis values, stored once per distinct value
+
+    Params are copied before processing replaces their image keys with image data. The images are
+    read back from redis and written by a background thread once the message is done, so recording
+    adds nothing to a job but the copy.
+    """
+
+    def __init__(self, corpus_dir, sample_rate=0.01, max_messages=1000, redact_prompts=True, max_pending=100):
+        self._corpus_dir = corpus_dir
+        self._sample_rate = sample_rate
+        self._max_messages = max_messages
+        self._redact_prompts = redact_prompts
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._sampled = 0
+        self._recorded = 0
+        self._dropped = 0
+
+    @property
+    def enabled(self):
+        return bool(self._corpus_dir) and self._sample_rate > 0
+
+    def _should_record(self):
+        if not self.enabled or random.random() >= self._sample_rate:
+            return False
+
+        with self._lock:
+            if self._sampled >= self._max_messages:
+                return False
+            self._sampled += 1
+
+            if self._thread is None:
+                os.makedirs(os.path.join(self._corpus_dir, IMAGES_DIR), exist_ok=True)
+                self._thread = threading.Thread(target=self._run, name='message-recorder', daemon=True)
+                self._thread.start()
+        return True
+
+    @contextmanager
+    def record(self, params):
+        """Processes the message in the block, recording it if it is sampled"""
+        if not self._should_record():
+            yield
+            return
+
+        message = {
+            'recorded_at': time.time(),
+            'params': redact_params(params, redact_values_of=PROMPT_KEYS if self._redact_prompts else ()),
+            'image_keys': get_image_keys(params),
+        }
+        started_at = time.monotonic()
+        with collect_stage_timings() as stage_timings:
+            try:
+                yield
+            finally:
+                message['seconds'] = time.monotonic() - started_at
+                message['stages'] = [list(stage_timing) for stage_timing in stage_timings]
+                try:
+                    self._queue.put_nowait(message)
+                except queue.Full:
+                    with self._lock:
+                        self._dropped += 1
+
+    def _run(self):
+        while True:
+            message = self._queue.get()
+            try:
+                self._write(message)
+            except Exception as e:
+                logger.warning(f"Couldn't record message: {e}")
+                with self._lock:
+                    self._dropped += 1
+
+    def _write(self, message):
+        image_keys = message.pop('image_keys')
+        images = {}
+        if image_keys:
+            for image_key, value in zip(image_keys, get_by_redis_keys(image_keys)):
+                if value is None:
+                    continue
+                if isinstance(value, str):
+                    value = value.encode('utf-8')
+
+                digest = hashlib.sha1(value).hexdigest()
+                path = os.path.join(self._corpus_dir, IMAGES_DIR, digest)
+                if not os.path.exists(path):
+                    with open(f'{path}.tmp', 'wb') as f:
+                        f.write(value)
+                    os.replace(f'{path}.tmp', path)
+                images[image_key] = digest
+        message['images'] = images
+
+        with open(os.path.join(self._corpus_dir, MESSAGES_FILE), 'a') as f:
+            f.write(json.dumps(message) + '\n')
+        with self._lock:
+            self._recorded += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sampled': self._sampled,
+                'recorded': self._recorded,
+                'dropped': self._dropped,
+                'pending': self._queue.qsize(),
+            }
+
+
+def read_corpus(corpus_dir):
+    """Recorded messages of a corpus in the order they were processed"""
+    with open(os.path.join(corpus_dir, MESSAGES_FILE)) as f:
+        messages = [json.loads(line) for line in f if line.strip()]
+    return sorted(messages, key=lambda message: message['recorded_at'])
+
+
+def read_corpus_image(corpus_dir, digest) -> bytes:
+    with open(os.path.join(corpus_dir, IMAGES_DIR, digest), 'rb') as f:
+        return f.read()
+
+
+message_recorder = MessageRecorder(
+    config.RECORD_CORPUS_DIR,
+    sample_rate=config.RECORD_SAMPLE_RATE,
+    max_messages=config.RECORD_MAX_MESSAGES,
+    redact_prompts=config.RECORD_REDACT_PROMPTS,
+)
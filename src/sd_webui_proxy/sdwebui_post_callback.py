@@ -1,14 +1,53 @@
-from urllib.parse import urljoin
-
 import src.config as config
 from src.common import amqp
 from src.common.logger import get_logger
-from src.sd_webui_proxy.util import get_redis_keys_tracking_key, set_base64_data_to_redis, set_redis_keys_tracking_key
-from src.sd_webui_proxy.sdwebui_post_callback_util import get_resized_images, post_request, get_generated_images, get_upscaled_images
+from src.common.metrics import jobs_total, time_stage
+from src.common.tracing import TRACEPARENT_HEADER, current_traceparent, start_span
+from src.sd_webui_proxy.backend_pool import get_backend_pool
+from src.sd_webui_proxy.cancellation import JobCancelledError, cancellation_watcher
+from src.sd_webui_proxy.postprocess import materialize_images
+from src.sd_webui_proxy.util import append_redis_keys_tracking_key, set_images_to_redis
+from src.sd_webui_proxy.sdwebui_post_callback_util import get_resized_images, get_generated_images, get_upscaled_images
 
 logger = get_logger()
 
 
+def publish_callback(callback_routing_key, callback_payload, callback_priority):
+    # Pass the job's trace context on so the callback's consumer can continue the trace
+    traceparent = current_traceparent()
+    headers = {TRACEPARENT_HEADER: traceparent} if traceparent else None
+
+    with time_stage("callback_publish"), start_span("amqp.publish", attributes={"routing_key": callback_routing_key}):
+        amqp.publish(
+            config.EXCHANGE_NAME,
+            callback_routing_key,
+            callback_payload,
+            None,
+            callback_priority,
+            headers=headers,
+        )
+    logger.info(f"Published to callback queue {callback_routing_key}")
+
+
+def sd_webui_post_callback_expired(params):
+    """
+    Fails a job whose deadline passed straight away - nothing is fetched from redis or sent to SD WebUI
+    """
+    callback_message = params.get("callback_message", {})
+
+    callback_routing_key = callback_message.get("routing_key", None)
+    assert callback_routing_key is not None, "callback_routing_key not provided"
+
+    callback_payload = callback_message.get("payload", None)
+    assert callback_payload is not None, "callback payload not provided"
+
+    callback_payload["result_images"] = None
+    callback_payload["error"] = "deadline_exceeded"
+    jobs_total.inc(outcome="expired")
+
+    publish_callback(callback_routing_key, callback_payload, callback_message.get("callback_priority", 255))
+
+
 def sd_webui_post_callback_processor(params):
     """
     Accepts config from genai-server and preprocess the config to send to SD WebUI worker.
@@ -35,55 +74,62 @@ def sd_webui_post_callback_processor(params):
 
         job_id = callback_payload.get("job_id")
 
-        redis_keys_list = get_redis_keys_tracking_key(job_id=job_id)
-
-        if sd_webui_options_payload is not None:
-            set_sd_webui_options_full_endpoint = urljoin(
-                config.SD_WEBUI_API_ENDPOINT, config.SET_SD_WEBUI_OPTIONS_ENDPOINT
-            )
-            post_request(url=set_sd_webui_options_full_endpoint,payload=sd_webui_options_payload,)
-            logger.info("Completed switching models")
-
-        # Generate images using SD WebUI
-        result_images = []
-        all_seeds_list = []
-        for request in requests:
-            images_list, seeds_list = get_generated_images(request)
-            result_images.extend(images_list)
-            all_seeds_list.extend(seeds_list)
-
-        # Upscale the generated images
-        if upscale_payload is not None:
-            upscaled_images = get_upscaled_images(upscale_payload=upscale_payload, result_images=result_images)
-            result_images = list(filter(None, upscaled_images))
+        # Stop at the next check, or interrupt SD WebUI when it's safe, once the job is flagged as cancelled
+        with cancellation_watcher.watch(job_id) as cancellation_token:
+            # Pick an SD WebUI backend, switch models on it only if needed and keep them loaded until
+            # generation and upscaling are done
+            backend_pool = get_backend_pool()
+            with backend_pool.lease(sd_webui_options_payload) as backend:
+                cancellation_token.backend = backend
+                cancellation_token.backend_pool = backend_pool
+
+                # Generate images using SD WebUI
+                result_images = []
+                all_seeds_list = []
+                for request in requests:
+                    images_list, seeds_list = get_generated_images(request, sd_webui_options_payload=sd_webui_options_payload,
+                                                                     api_endpoint=backend.url,
+                                                                     cancellation_token=cancellation_token)
+                    result_images.extend(images_list)
+                    all_seeds_list.extend(seeds_list)
+
+                # Upscale the generated images
+                if upscale_payload is not None:
+                    cancellation_token.check(refresh=True)
+                    with time_stage("upscale", config.BATCH_UPSCALE_ENDPOINT.strip("/")):
+                        upscaled_images = get_upscaled_images(upscale_payload=upscale_payload,
+                                                              result_images=result_images, api_endpoint=backend.url)
+                    result_images = list(filter(None, upscaled_images))
 
         # Resize if required
         if width is not None and height is not None:
-            result_images = get_resized_images(images=result_images, resize_width=width, resize_height=height)
+            with time_stage("resize"):
+                # Resizes are lazy, run them here so they're timed as resize and not as redis store
+                result_images = materialize_images(
+                    get_resized_images(images=result_images, resize_width=width, resize_height=height))
 
-        # To pass it on save the base64 data to redis keys and update the tracking keys list
-        result_images_s3_urls = []
-        for result_image in result_images:
-            s3_url = set_base64_data_to_redis(result_image)
-            redis_keys_list.append(s3_url)
-            result_images_s3_urls.append(s3_url)
+        # To pass it on save the image data to redis keys and update the tracking keys list
+        with time_stage("redis_store"):
+            result_images_s3_urls = set_images_to_redis(result_images)
 
         # Pass on result images references and seeds for post processing
         callback_payload["result_images"] = result_images_s3_urls
         callback_payload["all_seeds"] = all_seeds_list
 
-        set_redis_keys_tracking_key(job_id=job_id,redis_keys_list=redis_keys_list)
+        with time_stage("tracking_key_update"):
+            append_redis_keys_tracking_key(job_id=job_id, new_redis_keys=result_images_s3_urls)
+        jobs_total.inc(outcome="success")
+
+    except JobCancelledError as e:
+        callback_payload["result_images"] = None
+        callback_payload["error"] = "cancelled"
+        jobs_total.inc(outcome="cancelled")
+        logger.info(e)
 
     except Exception as e:
         callback_payload["result_images"] = None
+        jobs_total.inc(outcome="failed")
         logger.error(e, exc_info=True)
 
     finally:
-        amqp.publish(
-            config.EXCHANGE_NAME,
-            callback_routing_key,
-            callback_payload,
-            None,
-            callback_priority,
-        )
-        logger.info(f"Published to callback queue {callback_routing_key}")
+        publish_callback(callback_routing_key, callback_payload, callback_priority)
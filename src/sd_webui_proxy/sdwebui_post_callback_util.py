@@ -1,13 +1,26 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict
+from itertools import islice
 import json
+import time
 from typing import List
-from PIL import Image
 from urllib.parse import urljoin
 
+import requests
+
 import src.config as config
 from src.common.logger import get_logger
+from src.common.metrics import time_stage
+from src.common.tracing import run_in_context, start_span, traced
+from src.sd_webui_proxy.cancellation import CancellationToken
+from src.sd_webui_proxy.coalescer import coalescer
+from src.sd_webui_proxy.image_handle import ImageHandle
+from src.sd_webui_proxy.latency import AdaptiveTimeoutError, get_job_size, latency_tracker
+from src.sd_webui_proxy.postprocess import downscale_input_images, map_images, resize_images
+from src.sd_webui_proxy.streaming_json import decode_images_response
 from src.sd_webui_proxy.type import SDWebUIPayload, SDInterrogatePayload, UpscaleBatchImagesListPayload, BatchImagesListType
-from src.sd_webui_proxy.util import base64_to_image, image_to_base64, get_session, get_base64_data_from_redis
+from src.sd_webui_proxy.util import get_session, get_images_from_redis
 
 logger = get_logger()
 session = get_session(config.SERVER_POST_RETRIES, config.SERVER_POST_BACKOFF)
@@ -25,54 +38,152 @@ def is_controlnet_args_present(payload:SDWebUIPayload):
     )
 
 
-def replace_image_s3_url_to_base64(payload: SDWebUIPayload):
+def should_downscale_input_images(endpoint, payload: SDWebUIPayload):
+    return (
+        endpoint is not None
+        and endpoint.strip("/") in config.INPUT_IMAGE_DOWNSCALE_ENDPOINTS
+        and payload.get("width") is not None
+        and payload.get("height") is not None
+    )
+
+
+def replace_image_s3_url_to_base64(payload: SDWebUIPayload, endpoint=None):
     """
-    Replaces all s3 url redis keys with the corresponding base64 data so as to generate through SD WebUI
+    Replaces all s3 url redis keys with the corresponding base64 data so as to generate through SD WebUI.
+    All keys of the payload are fetched from redis in one round trip, and inputs much larger than the
+    requested width/height are downscaled first for endpoints in INPUT_IMAGE_DOWNSCALE_ENDPOINTS
     """
-    input_image_list = payload.get("init_images",[])
-    if input_image_list is not None and len(input_image_list)>0:
-        input_image_url = input_image_list[0]
-        input_image_base64 = get_base64_data_from_redis(input_image_url)
-        payload['init_images'] = [input_image_base64]
+    controlnet_args = []
+    if is_controlnet_args_present(payload) is True:
+        controlnet_args = payload['alwayson_scripts']['controlnet']['args']
 
+    input_image_list = payload.get("init_images",[])
+    init_image_url = input_image_list[0] if input_image_list is not None and len(input_image_list)>0 else None
     input_image_url = payload.get("input_image", None)
-    if(input_image_url is not None and len(input_image_url)>0):
-        input_image_base64 = get_base64_data_from_redis(input_image_url)
-        payload['input_image'] = input_image_base64
-
     input_image_mask_url = payload.get("mask", None)
-    if(input_image_mask_url is not None and len(input_image_mask_url)>0):
-        input_image_mask_base64 = get_base64_data_from_redis(input_image_mask_url)
-        payload['mask'] = input_image_mask_base64
 
-    if is_controlnet_args_present(payload) is True:
-        for cfg in payload['alwayson_scripts']['controlnet']['args']:
-            cfg_input_image = cfg.get("image")
-            if  cfg_input_image is not None and len(cfg_input_image)>0:
-                cfg["image"] = get_base64_data_from_redis(cfg_input_image)
+    s3_urls = [url for url in [init_image_url, input_image_url, input_image_mask_url] if url]
+    s3_urls.extend(cfg.get("image") for cfg in controlnet_args if cfg.get("image"))
+    with time_stage("redis_input_fetch", (endpoint or "").strip("/")):
+        images = get_images_from_redis(s3_urls)
+
+    if images and should_downscale_input_images(endpoint, payload):
+        images = downscale_input_images(images, payload["width"], payload["height"],
+                                        min_ratio=config.INPUT_IMAGE_DOWNSCALE_MIN_RATIO)
+
+    if init_image_url:
+        payload['init_images'] = [images[init_image_url].to_base64()]
+
+    if input_image_url:
+        payload['input_image'] = images[input_image_url].to_base64()
+
+    if input_image_mask_url:
+        payload['mask'] = images[input_image_mask_url].to_base64()
+
+    for cfg in controlnet_args:
+        cfg_input_image = cfg.get("image")
+        if cfg_input_image:
+            cfg["image"] = images[cfg_input_image].to_base64()
 
 
-def post_request(url, payload, timeout=config.SERVER_POST_TIMEOUT):
+def post_request(url, payload, timeout=None, stream=False):
     """
-    Posts requests to SD WebUI server and returns the result
+    Posts requests to SD WebUI server and returns the result.
+    Without an explicit timeout it is derived from the latency observed on url and the size of the job
+    with SD_WEBUI_ADAPTIVE_TIMEOUT, and exceeding a derived timeout raises AdaptiveTimeoutError
     """
-    logger.info(f"Posting to {url}")
-    response = session.post(url=url, json=payload, timeout=timeout)
-    response.raise_for_status()
+    job_size = get_job_size(payload)
+    adaptive = False
+    if timeout is None:
+        timeout = config.SERVER_POST_TIMEOUT
+        if config.SD_WEBUI_ADAPTIVE_TIMEOUT:
+            timeout = latency_tracker.get_timeout(url, job_size)
+            adaptive = timeout < config.SERVER_POST_TIMEOUT
+
+    logger.info(f"Posting to {url} with timeout {timeout:.0f}s")
+    started_at = time.monotonic()
+    with start_span("http.post", attributes={"http.url": url, "timeout": timeout, "job_size": job_size}) as span:
+        try:
+            response = session.post(url=url, json=payload, timeout=timeout, stream=stream)
+        except requests.exceptions.Timeout as e:
+            if adaptive:
+                raise AdaptiveTimeoutError(f"No response from {url} within the adaptive timeout of {timeout:.0f}s "
+                                           f"for job size {job_size:.1f}") from e
+            raise
+        span.set_attribute("http.status_code", response.status_code)
+        response.raise_for_status()
+
+    # SD WebUI only responds once the work is done, so time to the response headers is the job's latency
+    latency_tracker.record(url, time.monotonic() - started_at, job_size)
     return response
 
 
-def get_generated_images(requests):
+def get_response_images(response_json) -> List[ImageHandle]:
+    """
+    Wraps the base64 images of an SD WebUI response, skipping empty entries
+    """
+    images = response_json.get("images", None) or [
+        response_json.get("image", None)
+    ]
+    return [ImageHandle.from_base64(image) for image in images if image]
+
+
+@traced("http.read_images")
+def read_images_response(response):
+    """
+    Returns the images of an SD WebUI response together with the rest of the response json.
+    With SD_WEBUI_STREAMING_RESPONSE the images are base64 decoded while the body streams in
+    """
+    if not config.SD_WEBUI_STREAMING_RESPONSE:
+        response_json = response.json()
+        return get_response_images(response_json), response_json
+
+    try:
+        images, response_json = decode_images_response(
+            response.iter_content(chunk_size=config.SD_WEBUI_STREAM_CHUNK_SIZE))
+    finally:
+        response.close()
+
+    result_images = [ImageHandle.from_bytes(image) for image in images if image]
+    if len(result_images) == 0 and response_json.get("image"):
+        result_images = [ImageHandle.from_base64(response_json["image"])]
+    return result_images, response_json
+
+
+def post_generation_request(url, payload):
+    """
+    Posts a txt2img/img2img style request and returns the generated images and their seeds
+    """
+    response = post_request(url=url, payload=payload, stream=config.SD_WEBUI_STREAMING_RESPONSE)
+    try:
+        result_images, response_json = read_images_response(response)
+        seeds_list = []
+        response_info = response_json.get("info")
+        if response_info is not None:
+            seeds_list = json.loads(response_info).get("all_seeds")
+    except Exception as e:
+        logger.error(f"Error occurred: {e}")
+        result_images = []
+        seeds_list = []
+    return result_images, seeds_list
+
+
+def get_generated_images(requests, sd_webui_options_payload=None, api_endpoint=None, cancellation_token=None):
     """
-    For each config, image generation is triggered and returns generated_images base64 data
+    For each config, image generation is triggered on api_endpoint and returns generated images as ImageHandles.
+    Raises JobCancelledError before the next request, or when the running one returns, once the job is cancelled
     """
+    api_endpoint = api_endpoint or config.SD_WEBUI_API_ENDPOINT
+    cancellation_token = cancellation_token or CancellationToken()
     result_images = []
     seeds_list = []
     for request in requests:
+        cancellation_token.check(refresh=True)
+
         endpoint = request.get("endpoint", None)
         assert endpoint,"endpoint cannot be None"
 
-        full_endpoint = urljoin(config.SD_WEBUI_API_ENDPOINT, endpoint)
+        full_endpoint = urljoin(api_endpoint, endpoint)
 
         payload:SDWebUIPayload = request.get("payload", None)
         assert payload,"payload cannot be None"
@@ -80,27 +191,28 @@ def get_generated_images(requests):
         resize_payload = payload.get("resize_payload",None)
         no_of_samples = payload.get("batch_size", None)
 
-        replace_image_s3_url_to_base64(payload)
+        replace_image_s3_url_to_base64(payload, endpoint=endpoint)
 
         interrogate_model = request.get("interrogate_model", None)
         if interrogate_model:
             interrogate_endpoint = urljoin(
-                config.SD_WEBUI_API_ENDPOINT, config.SD_WEBUI_INTERROGATE_ENDPOINT)
+                api_endpoint, config.SD_WEBUI_INTERROGATE_ENDPOINT)
 
             interrogate_payload = asdict(SDInterrogatePayload(
                 image=payload.get('init_images')[0],
                 model=interrogate_model
             ))
 
-            interrogate_response = post_request(
-                url=interrogate_endpoint, payload=interrogate_payload)
-            interrogate_prompt = interrogate_response.json()['caption']
+            with time_stage("interrogate", config.SD_WEBUI_INTERROGATE_ENDPOINT.strip("/")):
+                interrogate_response = post_request(
+                    url=interrogate_endpoint, payload=interrogate_payload)
+                interrogate_prompt = interrogate_response.json()['caption']
 
             prompt = payload.get('prompt', "")
             payload['prompt'] = f"{interrogate_prompt} {prompt}"
 
         if len(result_images) > 0:
-            result_image_selected = result_images[0]
+            result_image_selected = result_images[0].to_base64()
 
             if "init_images" in payload:
                 payload["init_images"] = [result_image_selected]
@@ -109,27 +221,30 @@ def get_generated_images(requests):
                 for cfg in payload['alwayson_scripts']['controlnet']['args']:
                     cfg["input_image"] = result_image_selected
 
-        response = post_request(url=full_endpoint, payload=payload)
-        try:
-            response_json = response.json()
-            result_images = response_json.get("images", None) or [
-                response_json.get("image", None)
-            ]
-            response_info = response_json.get("info")
-            if response_info is not None:
-                seeds_list = json.loads(response_info).get("all_seeds")
+        with time_stage("generation", endpoint.strip("/")):
+            if coalescer.is_coalescable(endpoint, payload):
+                with cancellation_token.request(coalesced=True):
+                    result_images, seeds_list = coalescer.submit(
+                        # Only requests going to the same backend can be merged
+                        key=coalescer.get_key(full_endpoint, payload, sd_webui_options_payload),
+                        payload=payload,
+                        batch_size=no_of_samples or 1,
+                        execute=lambda merged_payload: post_generation_request(full_endpoint, merged_payload),
+                    )
+            else:
+                with cancellation_token.request():
+                    result_images, seeds_list = post_generation_request(full_endpoint, payload)
 
+        try:
             if no_of_samples is not None:
                 result_images = result_images[:no_of_samples]
 
             # If resize is required before inputing the output of one pipeline to the next pipeline
             if resize_payload is not None:
                 resize_width, resize_height = resize_payload.get("resize_width"), resize_payload.get("resize_height")
-                for ind,img in enumerate(result_images):
-                    image = base64_to_image(img)
-                    image = image.resize((resize_width,resize_height),Image.Resampling.LANCZOS)
-                    b64_image = image_to_base64(image)
-                    result_images[ind] = b64_image
+                # Lazy - only the image fed to the next request gets encoded, and a later resize of the
+                # same images is fused into this one
+                result_images = resize_images(result_images, resize_width, resize_height)
         except Exception as e:
             logger.error(f"Error occurred: {e}")
             result_images = []
@@ -137,43 +252,83 @@ def get_generated_images(requests):
     return result_images, seeds_list
 
 
-def get_resized_images(images:List, resize_width:int, resize_height:int) -> List:
-    resized_images = []
-    for img in images:
-        decoded_image = base64_to_image(img)
-        final_image = decoded_image.resize((resize_width, resize_height), Image.LANCZOS)
-        final_image_encoded = image_to_base64(final_image)
-        resized_images.append(final_image_encoded)
-    return resized_images
+def get_resized_images(images:List[ImageHandle], resize_width:int, resize_height:int) -> List[ImageHandle]:
+    return resize_images(images, resize_width, resize_height)
+
+
+def post_upscale_chunk(upscale_full_endpoint, upscale_payload, images:List[ImageHandle], offset:int=0) -> List[ImageHandle]:
+    """
+    Upscales one chunk of images, retrying the chunk up to UPSCALE_CHUNK_RETRIES times
+    """
+    images_base64 = map_images(lambda image: image.to_base64(), images)
+    chunk_payload = dict(upscale_payload)
+    chunk_payload.update(asdict(UpscaleBatchImagesListPayload(
+                imageList=[
+                    asdict(BatchImagesListType(name=f"image_{offset + index}", data=image))
+                    for index, image in enumerate(images_base64)
+                ]
+            )
+        ))
+
+    attempt = 0
+    while True:
+        try:
+            upscale_response = post_request(url=upscale_full_endpoint,payload=chunk_payload,
+                                            stream=config.SD_WEBUI_STREAMING_RESPONSE)
+            upscaled_images, _ = read_images_response(upscale_response)
+            return upscaled_images
+        except Exception as e:
+            attempt += 1
+            if attempt > config.UPSCALE_CHUNK_RETRIES:
+                raise
+            logger.warning(f"Upscaling images {offset}-{offset + len(images) - 1} failed, retrying: {e}")
 
 
-def get_upscaled_images(upscale_payload, result_images=[]):
+def iter_upscaled_images(upscale_payload, image_list:List[ImageHandle], api_endpoint=None):
+    """
+    Upscales image_list in chunks of UPSCALE_CHUNK_SIZE with up to UPSCALE_MAX_CONCURRENCY chunks in flight
+    and yields the upscaled images in input order as chunks complete
+    """
+    upscale_full_endpoint = urljoin(api_endpoint or config.SD_WEBUI_API_ENDPOINT, config.BATCH_UPSCALE_ENDPOINT)
+    chunk_size = config.UPSCALE_CHUNK_SIZE if config.UPSCALE_CHUNK_SIZE > 0 else len(image_list)
+    chunks = [(offset, image_list[offset:offset + chunk_size]) for offset in range(0, len(image_list), chunk_size)]
+
+    if len(chunks) == 1 or config.UPSCALE_MAX_CONCURRENCY <= 1:
+        for offset, chunk in chunks:
+            yield from post_upscale_chunk(upscale_full_endpoint, upscale_payload, chunk, offset)
+        return
+
+    with ThreadPoolExecutor(max_workers=config.UPSCALE_MAX_CONCURRENCY, thread_name_prefix='upscale') as executor:
+        chunks_iter = iter(chunks)
+        in_flight = deque(
+            executor.submit(run_in_context(post_upscale_chunk), upscale_full_endpoint, upscale_payload, chunk, offset)
+            for offset, chunk in islice(chunks_iter, config.UPSCALE_MAX_CONCURRENCY)
+        )
+        while in_flight:
+            upscaled_images = in_flight.popleft().result()
+
+            next_chunk = next(chunks_iter, None)
+            if next_chunk is not None:
+                offset, chunk = next_chunk
+                in_flight.append(executor.submit(run_in_context(post_upscale_chunk),
+                                                 upscale_full_endpoint, upscale_payload, chunk, offset))
+
+            yield from upscaled_images
+
+
+def get_upscaled_images(upscale_payload, result_images=[], api_endpoint=None) -> List[ImageHandle]:
     """
     Returns upscaled images
     """
-    upscale_full_endpoint = urljoin(config.SD_WEBUI_API_ENDPOINT, config.BATCH_UPSCALE_ENDPOINT)
     upscaled_images_list = upscale_payload.get("imageList", []) or []
 
     image_list = []
     if len(result_images) > 0:
         image_list = result_images
     else:
-        for image in upscaled_images_list:
-            image_list.append(get_base64_data_from_redis(image))
+        with time_stage("redis_input_fetch", config.BATCH_UPSCALE_ENDPOINT.strip("/")):
+            images = get_images_from_redis(upscaled_images_list)
+        image_list = [images[image] for image in upscaled_images_list]
 
     assert image_list, "Upscale image list cannot be empty or None"
-    upscaled_images_list = asdict(UpscaleBatchImagesListPayload(
-                imageList=[
-                    asdict(BatchImagesListType(name=f"image_{index}", data=image))
-                    for index, image in enumerate(image_list)
-                ]
-            )
-        )
-    upscale_payload.update(upscaled_images_list)
-
-    upscale_response = post_request(url=upscale_full_endpoint,payload=upscale_payload,)
-
-    upscale_response_json = upscale_response.json()
-    upscaled_images = upscale_response_json.get("images", [])
-
-    return upscaled_images
+    return list(iter_upscaled_images(upscale_payload, image_list, api_endpoint=api_endpoint))
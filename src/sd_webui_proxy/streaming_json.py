@@ -0,0 +1,187 @@
+import base64
+import json
+import re
+
+_STRUCTURAL = re.compile(rb'["{}\[\]]')
+_STRING_SPECIAL = re.compile(rb'["\\]')
+_WHITESPACE = b" \t\r\n"
+
+_SCAN = 0
+_IN_STRING = 1
+_AFTER_KEY = 2
+_AFTER_COLON = 3
+_IN_ARRAY = 4
+_IN_IMAGE = 5
+
+
+class ImagesResponseDecoder(object):
+    """Incremental decoder for SD WebUI JSON responses carrying a top-level "images" array.
+
+    Feed the raw response body chunk by chunk. Every string in the top-level "images" array is
+    base64 decoded while it streams in, so the full response text and its multi-megabyte base64
+    strings are never held in memory. Everything else is kept (with "images" replaced by an empty
+    list) and parsed with json once the body is complete.
+
+        decoder = ImagesResponseDecoder()
+        for chunk in response.iter_content(chunk_size=65536):
+            decoder.feed(chunk)
+        images, response_json = decoder.finish()
+    """
+
+    def __init__(self, key=b"images"):
+        self._key = b'"' + key + b'"'
+        self._buffer = bytearray()
+        self._residual = bytearray()
+        self._images = []
+        self._state = _SCAN
+        self._depth = 0
+        self._string_start = 0
+        self._image = None
+        self._pending_base64 = bytearray()
+
+    def feed(self, chunk: bytes):
+        self._buffer += chunk
+        pos = self._process(0)
+        del self._buffer[:pos]
+
+    def finish(self):
+        if self._buffer or self._state != _SCAN or self._depth != 0:
+            raise ValueError("Incomplete JSON response")
+        return self._images, json.loads(bytes(self._residual))
+
+    def _process(self, pos):
+        buffer = self._buffer
+        end = len(buffer)
+
+        while pos < end:
+            state = self._state
+
+            if state == _SCAN:
+                match = _STRUCTURAL.search(buffer, pos)
+                if match is None:
+                    self._residual += buffer[pos:]
+                    return end
+
+                index = match.start()
+                char = buffer[index]
+                self._residual += buffer[pos:index + 1]
+                pos = index + 1
+
+                if char == ord('"'):
+                    self._string_start = len(self._residual) - 1
+                    self._state = _IN_STRING
+                elif char in b"{[":
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+
+            elif state == _IN_STRING:
+                match = _STRING_SPECIAL.search(buffer, pos)
+                if match is None:
+                    self._residual += buffer[pos:]
+                    return end
+
+                index = match.start()
+                if buffer[index] == ord('\\'):
+                    if index + 1 >= end:
+                        # Wait for the escaped character
+                        self._residual += buffer[pos:index]
+                        return index
+                    self._residual += buffer[pos:index + 2]
+                    pos = index + 2
+                    continue
+
+                self._residual += buffer[pos:index + 1]
+                pos = index + 1
+                is_key = (
+                    self._depth == 1
+                    and len(self._residual) - self._string_start == len(self._key)
+                    and self._residual[self._string_start:] == self._key
+                )
+                self._state = _AFTER_KEY if is_key else _SCAN
+
+            elif state in (_AFTER_KEY, _AFTER_COLON):
+                char = buffer[pos]
+                if char in _WHITESPACE:
+                    self._residual.append(char)
+                    pos += 1
+                elif state == _AFTER_KEY and char == ord(':'):
+                    self._residual.append(char)
+                    pos += 1
+                    self._state = _AFTER_COLON
+                elif state == _AFTER_COLON and char == ord('['):
+                    self._residual += b"[]"
+                    pos += 1
+                    self._state = _IN_ARRAY
+                else:
+                    # Not the array we're after (e.g. "images" used as a value, or null)
+                    self._state = _SCAN
+
+            elif state == _IN_ARRAY:
+                char = buffer[pos]
+                if char in _WHITESPACE or char == ord(','):
+                    pos += 1
+                elif char == ord('"'):
+                    pos += 1
+                    self._image = bytearray()
+                    self._state = _IN_IMAGE
+                elif char == ord(']'):
+                    pos += 1
+                    self._state = _SCAN
+                elif char == ord('n'):
+                    if end - pos < 4:
+                        return pos
+                    if buffer[pos:pos + 4] != b"null":
+                        raise ValueError("Unexpected value in images array")
+                    self._images.append(None)
+                    pos += 4
+                else:
+                    raise ValueError("Unexpected value in images array")
+
+            elif state == _IN_IMAGE:
+                index = buffer.find(b'"', pos)
+                segment_end = end if index == -1 else index
+                segment = buffer[pos:segment_end]
+
+                if index == -1 and segment.endswith(b"\\"):
+                    # Incomplete escape at the end of the chunk
+                    segment = segment[:-1]
+                    segment_end -= 1
+
+                self._append_base64(segment)
+                pos = segment_end
+
+                if index == -1:
+                    return pos
+
+                pos = index + 1
+                self._append_base64(b"", final=True)
+                self._images.append(bytes(self._image))
+                self._image = None
+                self._state = _IN_ARRAY
+
+        return pos
+
+    def _append_base64(self, segment, final=False):
+        if b"\\" in segment:
+            segment = segment.replace(b"\\/", b"/").replace(b"\\n", b"").replace(b"\\r", b"")
+
+        pending = self._pending_base64
+        pending += segment
+
+        if final and len(pending) % 4:
+            pending += b"=" * (4 - len(pending) % 4)
+
+        decodable = len(pending) if final else len(pending) - len(pending) % 4
+        if decodable:
+            self._image += base64.b64decode(bytes(pending[:decodable]))
+            del pending[:decodable]
+
+
+def decode_images_response(chunks):
+    """Returns the decoded images of a top-level "images" array and the rest of the response"""
+    decoder = ImagesResponseDecoder()
+    for chunk in chunks:
+        if chunk:
+            decoder.feed(chunk)
+    return decoder.finish()
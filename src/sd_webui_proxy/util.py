@@ -3,15 +3,18 @@ import json
 import os
 import base64
 import logging
-from typing import List
+from typing import Dict, List
 import requests
 import time
 import urllib3
 import uuid
-import tempfile
+from src.common.tracing import traced
 from src.common.utils import acquire_redis_lock, release_redis_lock
-from src.sd_webui_proxy.constant import AI_MAGIC_TOOLS_REDIS_KEY_PREFIX
-from src.aws.aws import s3_public_url, upload_to_s3
+from src.sd_webui_proxy.constant import AI_MAGIC_TOOLS_REDIS_KEY_PREFIX, JOB_CANCELLATION_REDIS_KEY_PREFIX
+from src.sd_webui_proxy.image_cache import input_image_cache
+from src.sd_webui_proxy.image_handle import ImageHandle
+from src.sd_webui_proxy.postprocess import map_images
+from src.aws.aws import s3_public_url, upload_bytes_to_s3
 from src.common.redis import redis_connection
 
 import src.config as config
@@ -59,14 +62,16 @@ def get_session(retries: int, backoff_factor: int):
     return request_session
 
 
-def check_server_readiness(init_sleep_seconds: int = 0):
+def check_server_readiness(init_sleep_seconds: int = 0, api_endpoint: str = None):
+    api_endpoint = api_endpoint or config.SD_WEBUI_API_ENDPOINT
+
     if init_sleep_seconds > 0:
         logger.info(f"check_server_readiness() - sleep for {init_sleep_seconds} s")
         time.sleep(init_sleep_seconds)
 
     session = get_session(config.SERVER_CHECK_RETRIES, config.SERVER_CHECK_BACKOFF)
 
-    res = session.get(url=urljoin(config.SD_WEBUI_API_ENDPOINT, "/sdapi/v1/progress"),
+    res = session.get(url=urljoin(api_endpoint, "/sdapi/v1/progress"),
                       timeout=config.SERVER_CHECK_TIMEOUT)
     res.raise_for_status()
 
@@ -93,13 +98,15 @@ def base64_to_image(base64_image):
     return original_image
 
 def set_redis_key(redis_key: str, value: str, expiry=config.IMAGE_GENERATION_REDIS_EXPIRE):
-    redis_connection.set(redis_key, value)
-    redis_connection.expire(redis_key, expiry)
+    redis_connection.set(redis_key, value, ex=expiry)
 
 def get_by_redis_key(redis_key: str) -> str:
     value = redis_connection.get(redis_key)  
     return value
 
+def get_by_redis_keys(redis_keys: List[str]) -> List:
+    return redis_connection.mget(redis_keys)
+
 def set_base64_data_to_redis(base64_image:str)->str:
     s3_key = f"{str(uuid.uuid4())}.jpg"
     s3_url = s3_public_url(bucket=config.S3_BUCKET,key=s3_key)
@@ -109,79 +116,191 @@ def set_base64_data_to_redis(base64_image:str)->str:
     return s3_url
 
 def get_base64_data_from_redis(s3_url):
-    logger.info("Re-using image base64 from redis")
-    base64_image = get_by_redis_key(redis_key=s3_url)
-    base64_image = base64_image.decode('utf-8')
-    return base64_image
+    return get_image_from_redis(s3_url).to_base64()
+
+def get_redis_image_value(image: ImageHandle):
+    if config.REDIS_IMAGE_STORAGE_FORMAT == "raw":
+        return image.data
+    return image.to_base64()
+
+def set_image_to_redis(image: ImageHandle) -> str:
+    return set_images_to_redis([image])[0]
+
+@traced("redis.set_images")
+def set_images_to_redis(images: List[ImageHandle], expiry=config.IMAGE_GENERATION_REDIS_EXPIRE) -> List[str]:
+    """
+    Stores all images under new s3 url keys with a single pipelined round trip and returns the keys
+    """
+    s3_urls = [s3_public_url(bucket=config.S3_BUCKET, key=f"{str(uuid.uuid4())}.jpg") for _ in images]
+    if not images:
+        return s3_urls
+
+    # Pending resizes and encodes run in parallel before the single round trip
+    values = map_images(get_redis_image_value, images)
+
+    logger.info(f"Setting {len(images)} images to redis keys:{s3_urls}")
+    pipeline = redis_connection.pipeline(transaction=False)
+    for s3_url, value in zip(s3_urls, values):
+        pipeline.set(s3_url, value, ex=expiry)
+    pipeline.execute()
+    return s3_urls
+
+def get_image_from_redis(s3_url) -> ImageHandle:
+    return get_images_from_redis([s3_url])[s3_url]
+
+@traced("redis.get_images")
+def get_images_from_redis(s3_urls: List[str]) -> Dict[str, ImageHandle]:
+    """
+    Fetches all distinct s3 url keys with a single MGET and returns them keyed by url.
+    Values already in the in-process image cache are not fetched again
+    """
+    values = {}
+    unique_urls = list(dict.fromkeys(s3_urls))
+
+    if input_image_cache.enabled:
+        for s3_url in unique_urls:
+            value = input_image_cache.get(s3_url)
+            if value is not None:
+                values[s3_url] = value
+
+    missing_urls = [s3_url for s3_url in unique_urls if s3_url not in values]
+    if missing_urls:
+        logger.info(f"Re-using {len(missing_urls)} images from redis")
+        for s3_url, value in zip(missing_urls, redis_connection.mget(missing_urls)):
+            if value is None:
+                continue
+            values[s3_url] = value
+            if input_image_cache.enabled:
+                input_image_cache.put(s3_url, value)
+
+    not_found_urls = [s3_url for s3_url in unique_urls if s3_url not in values]
+    if not_found_urls:
+        raise KeyError(f"Images not found in redis: {not_found_urls}")
+
+    return {s3_url: ImageHandle.from_redis_value(value) for s3_url, value in values.items()}
 
 def get_generated_image_s3_key(
     base_filename: str, client_id: int, batch_uuid: str, image_ext: str
 ) -> str:
     return f"{os.path.join(base_filename,str(client_id),batch_uuid, str(uuid.uuid4()))}.{image_ext}"
 
+@traced("s3.upload")
 def upload_base64_to_s3(base64_data, s3_key):
-    with tempfile.TemporaryDirectory() as temp_dir:
-        input_image_data = base64.b64decode(base64_data)
-        file_path = os.path.join(temp_dir, f"{uuid.uuid4()}.jpg")
-        with open(file_path, "wb") as file:
-            file.write(input_image_data)
-        upload_to_s3(
-            filename=file_path,
-            bucket=config.AWS_S3_BUCKET,
-            key=s3_key,
-            public=True,
-        )
-
-def get_redis_keys_tracking_key(job_id:int) -> List:
-    redis_key = f"{AI_MAGIC_TOOLS_REDIS_KEY_PREFIX}_{job_id}"
-    redis_lock_key = f"{redis_key}_lock"
-    redis_lock = None
-    redis_keys_list = []
-
+    upload_bytes_to_s3(
+        base64.b64decode(base64_data),
+        bucket=config.AWS_S3_BUCKET,
+        key=s3_key,
+        content_type="image/jpeg",
+        public=True,
+    )
+
+# KEYS[1] = tracking key, ARGV[1] = expiry seconds, ARGV[2..] = keys to append
+APPEND_TRACKING_KEYS_JSON_SCRIPT = """
+local keys = {}
+local current = redis.call('GET', KEYS[1])
+if current then
+    keys = cjson.decode(current)
+end
+for i = 2, #ARGV do
+    keys[#keys + 1] = ARGV[i]
+end
+redis.call('SET', KEYS[1], cjson.encode(keys), 'EX', ARGV[1])
+return #keys
+"""
+
+APPEND_TRACKING_KEYS_LIST_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok == 'string' then
+    local legacy = cjson.decode(redis.call('GET', KEYS[1]))
+    redis.call('DEL', KEYS[1])
+    for i = 1, #legacy do
+        redis.call('RPUSH', KEYS[1], legacy[i])
+    end
+end
+for i = 2, #ARGV do
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return redis.call('LLEN', KEYS[1])
+"""
+
+_tracking_key_scripts = {}
+
+def get_tracking_key_script(mode):
+    if mode not in _tracking_key_scripts:
+        script = APPEND_TRACKING_KEYS_LIST_SCRIPT if mode == "list" else APPEND_TRACKING_KEYS_JSON_SCRIPT
+        _tracking_key_scripts[mode] = redis_connection.register_script(script)
+    return _tracking_key_scripts[mode]
+
+def get_redis_keys_tracking_key_name(job_id) -> str:
+    return f"{AI_MAGIC_TOOLS_REDIS_KEY_PREFIX}_{job_id}"
+
+@traced("redis.read_tracking_key")
+def read_redis_keys_tracking_key(job_id) -> List:
+    """
+    Lock-free read of the tracking key that understands both the JSON list and the Redis list format
+    """
+    redis_key = get_redis_keys_tracking_key_name(job_id)
     try:
-        try:
-            logger.info(f"Waiting to acquire image generation redis lock {redis_lock_key}")
-            redis_lock = acquire_redis_lock(redis_connection,
-                                            redis_lock_key,
-                                            expire=config.IMAGE_GENERATION_REDIS_LOCK_DURATION_SECONDS,
-                                            auto_renewal=False,
-                                            blocking=True)
-            redis_keys_list = get_by_redis_key(redis_key)
-        except Exception as e:
-            logger.info(f"Couldn't set redis key:{e}")
-        finally:
-            if redis_lock is not None:
-                release_redis_lock(redis_lock)
-                logger.info(f"Released generation redis lock {redis_lock}")
-        redis_keys_list = json.loads(redis_keys_list)
+        if redis_connection.type(redis_key) in (b"list", "list"):
+            return [key.decode('utf-8') for key in redis_connection.lrange(redis_key, 0, -1)]
+
+        value = get_by_redis_key(redis_key)
+        return json.loads(value) if value else []
     except Exception as e:
         logger.info(f"Couldn't get the redis key:{e}")
-        redis_keys_list=[]
-    finally:
-        return redis_keys_list
-
-def set_redis_keys_tracking_key(job_id, redis_keys_list):
-    redis_key = f"{AI_MAGIC_TOOLS_REDIS_KEY_PREFIX}_{job_id}"
-    redis_lock_key = f"{redis_key}_lock"
-    redis_lock = None
-
-    try:
-        redis_keys_list_bytes = json.dumps(redis_keys_list)
+        return []
+
+@traced("redis.append_tracking_key")
+def append_redis_keys_tracking_key(job_id, new_redis_keys: List[str]):
+    """
+    Appends new_redis_keys to the job's tracking key and refreshes its expiry
+    """
+    if not new_redis_keys:
+        return
+
+    mode = config.TRACKING_KEY_UPDATE_MODE
+    if mode == "redlock":
+        # Read and write under one lock so concurrent jobs can't overwrite each other's keys
+        redis_lock_key = f"{get_redis_keys_tracking_key_name(job_id)}_lock"
+        redis_lock = acquire_redis_lock(redis_connection,
+                                        redis_lock_key,
+                                        expire=config.IMAGE_GENERATION_REDIS_LOCK_DURATION_SECONDS,
+                                        auto_renewal=False,
+                                        blocking=True)
         try:
-            logger.info(f"Waiting to acquire image generation redis lock {redis_lock_key}")
-            redis_lock = acquire_redis_lock(redis_connection,
-                                                        redis_lock_key,
-                                                        expire=config.IMAGE_GENERATION_REDIS_LOCK_DURATION_SECONDS,
-                                                        auto_renewal=False,
-                                                        blocking=True)
-            logger.info("Setting all keys to redis")
-            set_redis_key(redis_key=redis_key,value=redis_keys_list_bytes,expiry=7200)
+            redis_keys_list = read_redis_keys_tracking_key(job_id)
+            redis_keys_list.extend(new_redis_keys)
+            set_redis_key(redis_key=get_redis_keys_tracking_key_name(job_id),
+                          value=json.dumps(redis_keys_list),
+                          expiry=config.IMAGE_GENERATION_TRACKING_KEY_EXPIRE)
         except Exception as e:
             logger.info(f"Couldn't set redis key:{e}")
         finally:
-            if redis_lock is not None:
-                release_redis_lock(redis_lock)
-                logger.info(f"Released generation redis lock {redis_lock}")
+            release_redis_lock(redis_lock)
+        return
 
+    try:
+        script = get_tracking_key_script(mode)
+        script(keys=[get_redis_keys_tracking_key_name(job_id)],
+               args=[config.IMAGE_GENERATION_TRACKING_KEY_EXPIRE, *new_redis_keys])
     except Exception as e:
-        logger.info(f"Couldn't set redis key:{e}")
\ No newline at end of file
+        logger.info(f"Couldn't set redis key:{e}")
+
+def get_job_cancellation_key_name(job_id) -> str:
+    return f"{JOB_CANCELLATION_REDIS_KEY_PREFIX}_{job_id}"
+
+def request_job_cancellation(job_id, expiry=config.IMAGE_GENERATION_REDIS_EXPIRE):
+    """
+    Flags job_id as cancelled - the worker running it stops at the next check and interrupts SD WebUI if it can
+    """
+    redis_connection.set(get_job_cancellation_key_name(job_id), 1, ex=expiry)
+
+@traced("redis.get_cancelled_job_ids")
+def get_cancelled_job_ids(job_ids: List) -> List:
+    """
+    The job ids among job_ids that have been flagged as cancelled, in one round trip
+    """
+    if not job_ids:
+        return []
+    values = redis_connection.mget([get_job_cancellation_key_name(job_id) for job_id in job_ids])
+    return [job_id for job_id, value in zip(job_ids, values) if value is not None]
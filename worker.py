@@ -1,26 +1,41 @@
 #!/usr/bin/env python3
 import argparse
 import os
+import time
 
 import src.config as config
 
 from threading import Thread
 
 from src.common.amqp import QueueConsumer, configure_queue
-from src.common.logger import get_logger
-from src.common.utils import sanitize_params_for_print
-from src.sd_webui_proxy.sdwebui_post_callback import sd_webui_post_callback_processor
-from src.sd_webui_proxy.util import check_server_readiness
+from src.common.deadline import deadline_stats, get_message_deadline, is_expired
+from src.common.logger import get_logger, logging_stats
+from src.common.metrics import observe_stage, registry, start_metrics_server, time_stage
+from src.common.tracing import extract_traceparent, start_span
+from src.common.scheduler import AffinityScheduler
+from src.common.utils import SanitizedParams
+from src.common.worker_pool import WorkerPool
+from src.sd_webui_proxy.backend_pool import get_backend_pool
+from src.sd_webui_proxy.cancellation import cancellation_watcher
+from src.sd_webui_proxy.coalescer import coalescer
+from src.sd_webui_proxy.image_cache import input_image_cache
+from src.sd_webui_proxy.latency import latency_tracker
+from src.sd_webui_proxy.model_state import get_checkpoint_key
+from src.sd_webui_proxy.recorder import message_recorder
+from src.sd_webui_proxy.sdwebui_post_callback import sd_webui_post_callback_expired, sd_webui_post_callback_processor
 
 
 logger = get_logger(__name__)
 
 
 message_processor = None
+expired_message_processor = None
 worker_name = None
+worker_pool = None
 worker_info = {
     'sd_webui_worker_sdxl': {
         'message_processor': sd_webui_post_callback_processor,
+        'expired_message_processor': sd_webui_post_callback_expired,
         'queue': os.environ.get('SDXL_WEBUI_WORKER_QUEUE', "sd_webui_sdxl_queue"),
         'routing_key': os.environ.get('SDXL_WEBUI_WORKER_ROUTING_KEY', "*.sdxl_webui.worker")
     }
@@ -43,16 +58,60 @@ def callback(params):
     if params['queue_consumer'] is None:
         raise RuntimeError('queue_consumer is None!!!.')
 
-    th = Thread(target=message_consumer, kwargs={'params': params}, daemon=False)
-    th.start()
+    received_at = time.monotonic()
+    if worker_pool is not None:
+        affinity_key = get_checkpoint_key(params.get('sd_webui_options_payload'))
+        worker_pool.submit(message_consumer, params=params, received_at=received_at, affinity_key=affinity_key)
 
+    else:
+        th = Thread(target=message_consumer, kwargs={'params': params, 'received_at': received_at}, daemon=False)
+        th.start()
 
-def message_consumer(params):
+
+def get_loaded_checkpoint_keys():
+    return get_backend_pool().loaded_checkpoint_keys()
+
+
+def register_component_stats(job_queue=None):
+    backend_pool = get_backend_pool()
+    registry.register_stats('backend_pool', backend_pool.stats, instance_label='backend')
+    registry.register_stats(
+        'options_state',
+        lambda: {backend.url: backend.options_state.stats() for backend in backend_pool.backends},
+        instance_label='backend')
+    registry.register_stats('post_latency', latency_tracker.stats, instance_label='url')
+    registry.register_stats('input_image_cache', input_image_cache.stats)
+    registry.register_stats('coalescer', coalescer.stats)
+    registry.register_stats('deadline', deadline_stats.stats)
+    registry.register_stats('cancellation', cancellation_watcher.stats)
+    registry.register_stats('logging', logging_stats)
+    if message_recorder.enabled:
+        registry.register_stats('recorder', message_recorder.stats)
+
+    if worker_pool is not None:
+        registry.register_stats('worker_pool', worker_pool.stats)
+    if job_queue is not None:
+        registry.register_stats('scheduler', job_queue.stats)
+
+
+def trace_message(params):
+    """Span of the whole job, continuing the trace of whoever published the message"""
+    callback_payload = (params.get('callback_message') or {}).get('payload') or {}
+    attributes = {'job_id': callback_payload.get('job_id'), 'worker': worker_name}
+    return start_span('process_message', attributes=attributes,
+                      traceparent=extract_traceparent(params, params.get('basic_properties')))
+
+
+def message_consumer(params, received_at=None):
     queue_consumer = params['queue_consumer']
     basic_deliver = params['basic_deliver']
 
+    if received_at is not None:
+        observe_stage(time.monotonic() - received_at, 'queue_wait')
+
     try:
-        process_message(params)
+        with time_stage('job'), trace_message(params):
+            process_message(params)
 
     except Exception as e:
         logger.error(f'Dropping message! E:{e}')
@@ -66,12 +125,26 @@ def process_message(params):
 
     logger.info('Received message:')
 
-    logger.info(f"{sanitize_params_for_print(params, hide_jwt=True, hide_list=True)}")
-    params = {k: v for k, v in params.items() if k not in ['queue_consumer', 'basic_deliver']}
+    # Sanitized only if logged, and once for both log lines, as received
+    sanitized_params = SanitizedParams(params, hide_jwt=True, hide_list=True)
+    logger.info('%s', sanitized_params)
+    basic_properties = params.get('basic_properties', None)
+    params = {k: v for k, v in params.items() if k not in ['queue_consumer', 'basic_deliver', 'basic_properties']}
 
     try:
-        if callable(message_processor):
-            message_processor(params)
+        # Shed messages nobody is waiting for anymore before fetching inputs or doing any GPU work
+        now = time.time()
+        deadline = get_message_deadline(params, basic_properties)
+        expired = is_expired(deadline, now)
+        deadline_stats.record(deadline, expired, now)
+
+        if expired and callable(expired_message_processor):
+            logger.warning(f"Message expired {now - deadline:.1f}s ago - sending failure callback without processing")
+            expired_message_processor(params)
+
+        elif callable(message_processor):
+            with message_recorder.record(params):
+                message_processor(params)
 
         else:
             raise RuntimeError(
@@ -80,7 +153,7 @@ def process_message(params):
     except Exception as e:
         logger.error(
             f'Error in worker:{worker_name} message: E: {e}', exc_info=True)
-        logger.info(f"{sanitize_params_for_print(params, hide_jwt=True, hide_list=True)}")
+        logger.info('%s', sanitized_params)
 
         raise
 
@@ -91,7 +164,9 @@ def main():
         exit(0)
 
     global message_processor
+    global expired_message_processor
     global worker_name
+    global worker_pool
 
     args = vars(parser.parse_args())
     worker_name = args.get('worker', None)
@@ -105,6 +180,7 @@ def main():
     priority = 255
 
     message_processor = worker_info[worker_name]['message_processor']
+    expired_message_processor = worker_info[worker_name].get('expired_message_processor', None)
 
     logger.info(f"Binding {worker_name} to exchange: {config.EXCHANGE_NAME}")
     configure_queue(config.RABBIT_URL,
@@ -128,20 +204,52 @@ def main():
             logger.warning(f"ENABLE_REQUEUE=False - not binding {worker_name} "
                            f"to delay exchange: {config.DELAY_EXCHANGE_NAME}")
 
+    prefetch_count = 1
+    job_queue = None
+    if config.WORKER_EXECUTION_MODE == 'pool':
+        # At least one prefetched message per slot, anything above that is the scheduling window
+        prefetch_count = max(config.WORKER_PREFETCH_COUNT, config.WORKER_CONCURRENCY)
+
+        if config.WORKER_SCHEDULER == 'model_affinity':
+            job_queue = AffinityScheduler(preferred_keys_fn=get_loaded_checkpoint_keys,
+                                          max_wait_seconds=config.SCHEDULER_MAX_WAIT_SECONDS,
+                                          max_bypass=config.SCHEDULER_MAX_BYPASS)
+
+        worker_pool = WorkerPool(max_workers=config.WORKER_CONCURRENCY, name=worker_name, job_queue=job_queue)
+        logger.info(f"Worker pool mode with {config.WORKER_CONCURRENCY} slots, prefetch {prefetch_count}, "
+                    f"scheduler {config.WORKER_SCHEDULER}")
+
+    if config.METRICS_PORT > 0:
+        registry.set_const_labels(worker=worker_name)
+        register_component_stats(job_queue)
+        start_metrics_server(config.METRICS_PORT, host=config.METRICS_HOST)
+
     consumer = QueueConsumer(
-        config.RABBIT_URL, worker_info[worker_name]['queue'], callback)
+        config.RABBIT_URL, worker_info[worker_name]['queue'], callback, prefetch_count=prefetch_count)
 
     try:
-        # Let this raise - we should not accept messages if we fail basic checks
-        check_server_readiness(init_sleep_seconds=config.SERVER_CHECK_INITIAL_DELAY)
+        # Let this raise - we should not accept messages if no backend passes basic checks
+        backend_pool = get_backend_pool()
+        backend_pool.check_readiness(init_sleep_seconds=config.SERVER_CHECK_INITIAL_DELAY)
         logger.info(f"Server is ready - starting consumer & connecting to queue")
 
+        if config.PAUSE_CONSUMING_WHEN_UNAVAILABLE:
+            backend_pool.add_availability_listener(
+                lambda available: consumer.resume_consuming() if available else consumer.pause_consuming())
+        backend_pool.start()
+
+        if worker_pool is not None:
+            worker_pool.start()
+
         consumer.run()
 
     except KeyboardInterrupt:
         logger.info(f'\nExiting Worker')
         consumer.stop()
         consumer.close_connection()
+        get_backend_pool().stop()
+        if worker_pool is not None:
+            worker_pool.shutdown(wait=False)
         logger.info('Bye!!!')
 
 